@@ -0,0 +1,237 @@
+"""
+Energy accounting for a firing. Integrates the measured relay on-time (not the throttle command, which the burst
+window only approximates) against the element power, and keeps per-segment and per-firing kWh, a cost estimate,
+the peak demand over a rolling window and a projection of the energy the rest of the schedule will use.
+"""
+import threading
+import time
+from collections import deque
+from metrics import REGISTRY
+from scheduler import ScheduleRamp, ScheduleHold, ScheduleCool
+
+# Seconds between samples fed to the power model used for the remaining energy projection
+MODEL_SAMPLE_SECONDS = 60
+
+
+class EnergyMeter:
+
+    def __init__(self, kiln, element_watts, rated_voltage=240, supply_voltage=None, cost_per_kwh=0.0,
+                 demand_window_minutes=15, labels=None):
+        """
+        :param kiln: Kiln being metered. Its throttle interface supplies the relay on-time
+        :param element_watts: Element power at rated_voltage
+        :param rated_voltage: Voltage element_watts is specified at
+        :param supply_voltage: Measured supply voltage. Resistive elements scale with voltage squared. None assumes
+        rated_voltage
+        :param cost_per_kwh: Electricity price, for the running cost estimate
+        :param demand_window_minutes: Averaging window for peak demand (utilities commonly bill 15 minute demand)
+        :param labels: Metric labels identifying this kiln
+        """
+        self.kiln = kiln
+        self.element_watts = element_watts
+        self.rated_voltage = rated_voltage
+        self.supply_voltage = supply_voltage
+        self.cost_per_kwh = cost_per_kwh
+        self.demand_window_seconds = demand_window_minutes * 60
+
+        self.energy_kwh = 0.0
+        self.segment_kwh = [0.0] * len(kiln.scheduler.schedule)
+        self.peak_demand_kw = 0.0
+        self.demand_kw = 0.0
+        self._last_on_seconds = None
+
+        # update() runs from the kiln's run loop (or the KilnManager executive) and from Kiln.shutdown() on whichever
+        # thread shut the kiln down
+        self._lock = threading.Lock()
+
+        # Energy metered by this process, for the average power fallback (a resumed firing restores energy_kwh)
+        self._start_time = time.monotonic()
+        self._metered_kwh = 0.0
+
+        # (monotonic time, energy_kwh) samples covering the demand window
+        self._demand_samples = deque()
+
+        # Least squares fit of average power against temperature and programmed rate:
+        # power_kw = a + b * temp_f + c * rate_f_per_hour. Sums of the normal equations, updated once per sample
+        self._model_sums = [[0.0] * 4 for _ in range(3)]
+        self._model_count = 0
+        self._model_sample = None
+
+        # Instrumentation
+        self._energy_gauge = REGISTRY.gauge("kiln_energy_kwh", "Energy used by the current firing", labels)
+        self._demand_gauge = REGISTRY.gauge("kiln_power_demand_kw", "Average power over the demand window", labels)
+
+    def get_element_kw(self):
+        """
+        :return: Element power at the current supply voltage
+        """
+        watts = self.element_watts
+        if self.supply_voltage is not None:
+            watts *= (self.supply_voltage / self.rated_voltage) ** 2
+        return watts / 1000
+
+    def set_supply_voltage(self, volts):
+        # Takes effect from the next update - energy already counted keeps the voltage it was used at
+        self.supply_voltage = volts
+
+    def update(self):
+        """
+        Adds the relay on-time since the last update to the firing and current segment. Call at least every few
+        seconds - the kiln run loop or the KilnManager control executive does this once per second.
+        """
+        with self._lock:
+            self._update()
+
+    def _update(self):
+        now = time.monotonic()
+        on_seconds = self.kiln.throttle_interface.get_relay_on_seconds()
+        if self._last_on_seconds is None:
+            self._last_on_seconds = on_seconds
+        kwh = (on_seconds - self._last_on_seconds) * self.get_element_kw() / 3600
+        self._last_on_seconds = on_seconds
+
+        self.energy_kwh += kwh
+        self._metered_kwh += kwh
+        index = self.kiln.scheduler.get_schedule_index()
+        if index < len(self.segment_kwh):
+            self.segment_kwh[index] += kwh
+
+        # Rolling demand. Keep one sample at or before the window start to measure from
+        self._demand_samples.append((now, self.energy_kwh))
+        while len(self._demand_samples) > 1 and self._demand_samples[1][0] <= now - self.demand_window_seconds:
+            self._demand_samples.popleft()
+        start_time, start_kwh = self._demand_samples[0]
+        if now - start_time > 0:
+            self.demand_kw = (self.energy_kwh - start_kwh) * 3600 / (now - start_time)
+            # Only a full window counts towards the peak, as on a demand meter
+            if now - start_time >= self.demand_window_seconds:
+                self.peak_demand_kw = max(self.peak_demand_kw, self.demand_kw)
+
+        self._update_model(now, index)
+        self._energy_gauge.value = self.energy_kwh
+        self._demand_gauge.value = self.demand_kw
+
+    def _update_model(self, now, index):
+        if self._model_sample is None:
+            self._model_sample = (now, self.energy_kwh, index)
+            return
+        start_time, start_kwh, start_index = self._model_sample
+        if now - start_time < MODEL_SAMPLE_SECONDS:
+            return
+        self._model_sample = (now, self.energy_kwh, index)
+        # Samples spanning a step change mix two rates - drop them
+        if index != start_index or index >= len(self.kiln.scheduler.schedule):
+            return
+
+        power_kw = (self.energy_kwh - start_kwh) * 3600 / (now - start_time)
+        x = (1.0, self.kiln.thermocouple_temp_f, _programmed_rate(self.kiln.scheduler.schedule[index]))
+        for row in range(3):
+            for column in range(3):
+                self._model_sums[row][column] += x[row] * x[column]
+            self._model_sums[row][3] += x[row] * power_kw
+        self._model_count += 1
+
+    def _model_coefficients(self):
+        """
+        :return: (a, b, c) of the power fit, or None until the fit is well conditioned
+        """
+        if self._model_count < 10:
+            return None
+        matrix = [list(row) for row in self._model_sums]
+        # Ridge term keeps the fit solvable before both a ramp and a hold have been seen
+        for diagonal in range(1, 3):
+            matrix[diagonal][diagonal] += 1e-6 * (1 + matrix[diagonal][diagonal])
+        for pivot in range(3):
+            best = max(range(pivot, 3), key=lambda row: abs(matrix[row][pivot]))
+            if abs(matrix[best][pivot]) < 1e-12:
+                return None
+            matrix[pivot], matrix[best] = matrix[best], matrix[pivot]
+            for row in range(3):
+                if row != pivot:
+                    factor = matrix[row][pivot] / matrix[pivot][pivot]
+                    for column in range(pivot, 4):
+                        matrix[row][column] -= factor * matrix[pivot][column]
+        return tuple(matrix[row][3] / matrix[row][row] for row in range(3))
+
+    def _predict_kw(self, coefficients, temp_f, rate_f_per_hour):
+        if coefficients is None:
+            return self._average_kw()
+        a, b, c = coefficients
+        return min(max(a + b * temp_f + c * rate_f_per_hour, 0.0), self.get_element_kw())
+
+    def _average_kw(self):
+        elapsed_hours = (time.monotonic() - self._start_time) / 3600
+        if elapsed_hours <= 0:
+            return 0.0
+        return self._metered_kwh / elapsed_hours
+
+    def get_projected_remaining_kwh(self):
+        """
+        Estimates the energy the rest of the schedule will use, from the programmed rates and hold times and the
+        power the kiln has needed so far at each temperature and rate. Falls back to the firing's average power
+        until enough of the firing has been seen to fit.
+        """
+        schedule = self.kiln.scheduler.schedule
+        index = self.kiln.scheduler.get_schedule_index()
+        coefficients = self._model_coefficients()
+        temp_f = max(self.kiln.setpoint_f, self.kiln.thermocouple_temp_f) if index < len(schedule) else 0
+        kwh = 0.0
+        for position in range(index, len(schedule)):
+            step = schedule[position]
+            rate = _programmed_rate(step)
+            if isinstance(step, ScheduleHold):
+                minutes = step.remaining_minutes if position == index else step.hold_time_minutes
+                hours = max(minutes, 0) / 60
+                end_temp = step.hold_temp_f
+            else:
+                end_temp = step.target_f
+                hours = max((end_temp - temp_f) / rate, 0)
+            # Power is linear in temperature, so the midpoint gives the segment's average
+            kwh += self._predict_kw(coefficients, (temp_f + end_temp) / 2, rate) * hours
+            if hours > 0 or isinstance(step, ScheduleHold):
+                temp_f = end_temp
+        return kwh
+
+    def get_cost(self):
+        return self.energy_kwh * self.cost_per_kwh
+
+    def get_checkpoint(self):
+        return {"energy_kwh": self.energy_kwh, "segment_kwh": self.segment_kwh, "peak_demand_kw": self.peak_demand_kw}
+
+    def restore_checkpoint(self, checkpoint):
+        """
+        Carries the energy used before a crash over into the resumed firing
+        """
+        self.energy_kwh = checkpoint.get("energy_kwh", 0.0)
+        self.peak_demand_kw = checkpoint.get("peak_demand_kw", 0.0)
+        segment_kwh = checkpoint.get("segment_kwh", [])
+        if len(segment_kwh) == len(self.segment_kwh):
+            self.segment_kwh = list(segment_kwh)
+
+    def get_state(self):
+        index = self.kiln.scheduler.get_schedule_index()
+        return {
+            "energy_kwh": round(self.energy_kwh, 3),
+            "energy_cost": round(self.get_cost(), 2),
+            "segment_energy_kwh": round(self.segment_kwh[index], 3) if index < len(self.segment_kwh) else 0,
+            "power_demand_kw": round(self.demand_kw, 2),
+            "peak_demand_kw": round(self.peak_demand_kw, 2),
+            "projected_remaining_kwh": round(self.get_projected_remaining_kwh(), 2),
+        }
+
+    def get_stats(self):
+        text = "Energy Used: " + str(round(self.energy_kwh, 2)) + "kWh"
+        if self.cost_per_kwh:
+            text += " (" + str(round(self.get_cost(), 2)) + ")"
+        text += "\nDemand: " + str(round(self.demand_kw, 2)) + "kW, Peak: " + str(round(self.peak_demand_kw, 2))
+        text += "kW\nProjected Remaining: " + str(round(self.get_projected_remaining_kwh(), 1)) + "kWh\n"
+        return text
+
+
+def _programmed_rate(step):
+    # Signed setpoint rate the step asks for, in F per hour
+    if isinstance(step, ScheduleRamp):
+        return step.rate_deg_f
+    if isinstance(step, ScheduleCool):
+        return -step.rate_deg_f
+    return 0
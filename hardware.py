@@ -0,0 +1,121 @@
+"""
+Hardware backends for the thermocouple SPI bus and the relay GPIO. A backend's modules are only imported when it
+is selected, so a simulated or replayed kiln never needs spidev or RPi.GPIO installed.
+
+real      - spidev + RPi.GPIO on a Raspberry Pi
+simulated - simulator.ThermalModel driven by the relay, read through a simulated MAX31856
+record    - another backend, with its SPI traffic recorded to a file (see spi_replay.py)
+replay    - SPI responses from a recording, relay switching only simulated
+"""
+
+
+class RealBackend:
+
+    def __init__(self):
+        import spidev
+        import RPi.GPIO
+        self._spidev = spidev
+        self.gpio = RPi.GPIO
+
+    def open_spi(self, bus_number, device_id):
+        # Enable SPI
+        spi = self._spidev.SpiDev()
+
+        # Open connection to bus and device (chip select pin)
+        spi.open(bus_number, device_id)
+
+        # Set SPI speed and mode
+        spi.max_speed_hz = 4000000
+        spi.mode = 0b01
+        spi.lsbfirst = False
+        return spi
+
+    def attach_relay(self, relay_pin, share=1.0):
+        # Real relays switch real elements - nothing to connect
+        pass
+
+
+class SimulatedBackend:
+    # One thermal model per backend, so every simulated kiln heats independently
+
+    def __init__(self, **model_options):
+        """
+        :param model_options: simulator.ThermalModel arguments (ambient_f, time_scale, ...)
+        """
+        import simulator
+        self.model = simulator.ThermalModel(**model_options)
+        self.gpio = simulator.SimulatedGPIO()
+        self._simulator = simulator
+
+    def open_spi(self, bus_number, device_id):
+        return self._simulator.SimulatedMax31856(self.model)
+
+    def attach_relay(self, relay_pin, share=1.0):
+        # Relay pin switches this backend's model elements - share of the element power, for element zones
+        self.gpio.pin_models[relay_pin] = self.model
+        if share != 1.0:
+            self.model.add_element(relay_pin, share)
+
+
+class RecordingBackend:
+    # Records the SPI traffic of another backend - the relay and everything else is the wrapped backend's
+
+    def __init__(self, path, inner="real", **inner_options):
+        """
+        :param path: Recording file. '{bus}' and '{device}' are filled in, for one file per chip select
+        :param inner: Backend name to record
+        :param inner_options: Options for the recorded backend
+        """
+        import spi_replay
+        self.path = path
+        self.inner = get_backend(inner, **inner_options)
+        self.gpio = self.inner.gpio
+        self._spi_replay = spi_replay
+
+    def open_spi(self, bus_number, device_id):
+        path = self.path.format(bus=bus_number, device=device_id)
+        return self._spi_replay.SpiRecorder(self.inner.open_spi(bus_number, device_id), path)
+
+    def attach_relay(self, relay_pin, share=1.0):
+        self.inner.attach_relay(relay_pin, share)
+
+
+class ReplayBackend:
+    # Thermocouple readings come from a recording. Relay outputs go to a simulated GPIO with no elements attached
+
+    def __init__(self, path, speed=1.0):
+        """
+        :param path: Recording file. '{bus}' and '{device}' are filled in, as when recording
+        :param speed: Replay speed relative to the recording. None or 0 replays as fast as possible
+        """
+        import simulator
+        import spi_replay
+        self.path = path
+        self.speed = speed
+        self.gpio = simulator.SimulatedGPIO()
+        self._spi_replay = spi_replay
+
+    def open_spi(self, bus_number, device_id):
+        return self._spi_replay.ReplaySpi(self.path.format(bus=bus_number, device=device_id), self.speed)
+
+    def attach_relay(self, relay_pin, share=1.0):
+        pass
+
+
+BACKENDS = {
+    "real": RealBackend,
+    "simulated": SimulatedBackend,
+    "record": RecordingBackend,
+    "replay": ReplayBackend,
+}
+
+
+def get_backend(name="real", **options):
+    """
+    Creates a hardware backend by name
+    :param name: One of BACKENDS
+    :param options: Backend specific options
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown hardware backend '" + str(name) + "'. Available: " + ", ".join(BACKENDS))
+    return BACKENDS[name](**options)
@@ -1,64 +1,160 @@
 import time
-import curses
+import signal
+import argparse
 from datetime import datetime
 import csv
+import hardware
 from max31856_driver import max_controller
 from scheduler import Scheduler, ScheduleRamp, ScheduleHold
+from schedule_loader import load_schedule
 from pi_controller import PIController
-from throttle_interface import ThrottleInterface
+from throttle_interface import ThrottleInterface, MultiZoneThrottle
 from monitor import Monitor
+from energy import EnergyMeter
+from metrics import REGISTRY
+from tracer import TRACER
 
 
 class Kiln:
 
-    def __init__(self):
+    def __init__(self, name="kiln", spi_bus=0, spi_device=0, relay_pin=36, schedule_file=None, program="default",
+                 log_file="kiln.csv", checkpoint_file="kiln_checkpoint.json", resume=False, telemetry_port=8080,
+                 metrics_file=None, trace_file=None, standalone=True, backend="real", backend_options=None,
+                 headless=False, element_watts=None, rated_voltage=240, supply_voltage=None, cost_per_kwh=0.0,
+                 zones=None, load_budget=None):
+        """
+        :param name: Kiln name, used in metrics labels and status views
+        :param spi_bus: SPI bus of the MAX31856 thermocouple amp
+        :param spi_device: SPI device (chip select) of the MAX31856 thermocouple amp
+        :param relay_pin: Raspberry Pi header pin driving the element relay
+        :param schedule_file: Schedule file to load the firing program from. None uses the built in schedule
+        :param program: Program name in the schedule file
+        :param log_file: CSV firing log
+        :param checkpoint_file: Scheduler checkpoint used to resume after a crash. None disables checkpointing
+        :param resume: Resume the firing from checkpoint_file
+        :param telemetry_port: Port for the telemetry API. None disables it
+        :param metrics_file: Optional Prometheus textfile, rewritten with every log row
+        :param trace_file: Enables span tracing. The trace is written here on shutdown or on dump_trace()
+        :param standalone: If True the kiln runs its own threads, curses screen and telemetry server. If False
+        it is driven by a KilnManager
+        :param backend: Hardware backend name (see hardware.BACKENDS) or a backend object
+        :param backend_options: Options for the named backend (ie. simulator model settings)
+        :param headless: Run without the curses screen
+        :param element_watts: Element power at rated_voltage. Enables energy accounting
+        :param rated_voltage: Voltage element_watts is specified at
+        :param supply_voltage: Measured supply voltage, if different from rated_voltage
+        :param cost_per_kwh: Electricity price, for the firing cost estimate
+        :param zones: Element zones with their own relays, replacing relay_pin. List of {"relay_pin": pin,
+        "load": zone current or power, "bias": zone duty multiplier (ie. 1.1 for a cold bottom zone)}
+        :param load_budget: Max total load of zones on at once, in the unit of the zone loads
+        """
+        self.name = name
+        self.standalone = standalone
+        self.log_file = log_file
+        self.headless = headless
+        labels = {"kiln": name}
+
+        # Hardware backend - only the selected backend's modules get imported
+        if isinstance(backend, str):
+            backend = hardware.get_backend(backend, **(backend_options or {}))
+        self.hardware = backend
+
+        # Span tracing is opt-in. The trace is written to trace_file on shutdown or on dump_trace()
+        self.trace_file = trace_file
+        if trace_file is not None:
+            TRACER.enable()
+
         # Thermocouple Amp Values
-        self.max_controller = max_controller.MAXController(self, 0, 0, 1)
+        self.max_controller = max_controller.MAXController(self, spi_bus, spi_device, 1, labels, backend)
         self.thermocouple_temp_c = 0
         self.thermocouple_temp_f = 0
         self.cold_junc_temp_c = 0
         self.cold_junc_temp_f = 0
-        time.sleep(1)  # Wait for initial readings
+        self.highest_achieved_temp = 0
 
         # Scheduler Values
-        self.scheduler = Scheduler(self)
+        self.scheduler = Scheduler(self, checkpoint_file, labels=labels)
         self.setpoint_f = 0
+        self.scheduler.ready_event = self.max_controller.first_sample_event  # Start on the first valid reading
 
-        # Warmup ramp
-        self.scheduler.schedule.append(ScheduleRamp(100, 100))
+        if schedule_file is not None:
+            # Named program from a schedule file (see schedule_loader.py for the format)
+            self.scheduler.schedule.extend(load_schedule(schedule_file, program))
+        else:
+            # Warmup ramp
+            self.scheduler.schedule.append(ScheduleRamp(100, 100))
 
-        # Fast ramp to 200
-        self.scheduler.schedule.append(ScheduleRamp(300, 200))
+            # Fast ramp to 200
+            self.scheduler.schedule.append(ScheduleRamp(300, 200))
 
-        # Hold at 200 for 2 hours
-        self.scheduler.schedule.append(ScheduleHold(200, 120))
+            # Hold at 200 for 2 hours
+            self.scheduler.schedule.append(ScheduleHold(200, 120))
 
-        # 3 Stage ramp to 1950 End Temp
-        self.scheduler.schedule.append(ScheduleRamp(200, 550))
-        self.scheduler.schedule.append(ScheduleRamp(300, 1150))
-        self.scheduler.schedule.append(ScheduleRamp(400, 1950))
+            # 3 Stage ramp to 1950 End Temp
+            self.scheduler.schedule.append(ScheduleRamp(200, 550))
+            self.scheduler.schedule.append(ScheduleRamp(300, 1150))
+            self.scheduler.schedule.append(ScheduleRamp(400, 1950))
 
         # PI Controller Values
-        self.pi_controller = PIController(self, 2, 0.01, 1)
+        self.pi_controller = PIController(self, 2, 0.01, 1, labels=labels)
         self.throttle_percent = 0
+        self.pi_controller.ready_event = self.scheduler.first_tick_event  # Start once there is a setpoint
+
+        # Energy accounting - disabled unless the element power is configured
+        self.energy_meter = None
+        if element_watts is not None:
+            self.energy_meter = EnergyMeter(self, element_watts, rated_voltage, supply_voltage, cost_per_kwh,
+                                            labels=labels)
+
+        # Resume a crashed firing from the scheduler checkpoint
+        self.resumed = False
+        if resume:
+            # Resume needs the current temp before any thread starts
+            if self.max_controller.read_first_sample():
+                self.resumed = self.scheduler.resume_from_checkpoint()
+            else:
+                print("Kiln: No valid thermocouple reading - not resuming")
 
         # Throttle Interface Values
-        self.throttle_interface = ThrottleInterface(36)
+        self.zone_biases = None
+        if zones:
+            # Each zone gets its own duty, phased against the load budget by the multi-zone throttle
+            total_load = sum(zone.get("load", 1) for zone in zones)
+            for zone in zones:
+                backend.attach_relay(zone["relay_pin"], zone.get("load", 1) / total_load)
+            self.zone_biases = [zone.get("bias", 1.0) for zone in zones]
+            self.throttle_interface = MultiZoneThrottle(zones, load_budget, labels, backend.gpio)
+        else:
+            backend.attach_relay(relay_pin)
+            self.throttle_interface = ThrottleInterface(relay_pin, labels, backend.gpio)
 
         # Monitor
-        self.monitor = Monitor(self, 300, 50, 120)
+        self.monitor = Monitor(self, 300, 50, 120, labels)
 
         # Misc Values
         self.start_time = datetime.now()
         self.file_write_interval = 0
-        self.highest_achieved_temp = 0
         self.is_shutdown = False
+        self.metrics_file = metrics_file  # Optional Prometheus textfile, rewritten with every log row
+
+        # A managed kiln is driven by the KilnManager's shared threads and status view
+        self.telemetry_server = None
+        if not standalone:
+            return
 
         # Curses for screen writing
-        self.stdscr = curses.initscr()
-        curses.curs_set(False)
-        self.stdscr.clear()
-        self.stdscr.refresh()
+        self.stdscr = None
+        if not headless:
+            import curses
+            self.stdscr = curses.initscr()
+            curses.curs_set(False)
+            self.stdscr.clear()
+            self.stdscr.refresh()
+
+        # Telemetry API (localhost only) - disabled if no port given
+        if telemetry_port is not None:
+            from telemetry_server import TelemetryServer
+            self.telemetry_server = TelemetryServer(self.get_state, port=telemetry_port)
 
         # Start the threads
         self.max_controller.start_spi_thread()
@@ -66,6 +162,8 @@ class Kiln:
         self.pi_controller.start_pi_thread()
         self.throttle_interface.start_throttle_thread()
         self.monitor.start_monitor_thread()
+        if self.telemetry_server is not None:
+            self.telemetry_server.start_server_thread()
 
     def set_thermocouple_temp_c(self, temp_c):
         self.thermocouple_temp_c = temp_c
@@ -83,48 +181,138 @@ class Kiln:
         if throttle_percent > 100:
             throttle_percent = 100
         self.throttle_percent = throttle_percent
-        self.throttle_interface.set_throttle(throttle_percent)
+        if self.zone_biases is None:
+            self.throttle_interface.set_throttle(throttle_percent)
+            return
+        for zone, bias in enumerate(self.zone_biases):
+            self.throttle_interface.set_zone_throttle(zone, max(0, min(100, int(round(throttle_percent * bias)))))
+
+    def get_state(self):
+        state = {
+            "time": time.time(),
+            "state": "RUNNING" if not self.is_shutdown else "SHUTDOWN",
+            "elapsed_seconds": int((datetime.now() - self.start_time).total_seconds()),
+            "highest_achieved_temp_f": round(self.highest_achieved_temp, 1),
+            "thermocouple_temp_f": round(self.thermocouple_temp_f, 1),
+            "cold_junc_temp_f": round(self.cold_junc_temp_f, 1),
+            "setpoint_f": round(self.setpoint_f, 1),
+            "error_f": round(self.pi_controller.error, 1),
+            "throttle_percent": round(self.throttle_percent, 1),
+            "p_value": round(self.pi_controller.p_value, 2),
+            "i_value": round(self.pi_controller.i_value, 2),
+            "schedule_step": self.scheduler.get_schedule_index() + 1,
+            "schedule_length": len(self.scheduler.schedule),
+            "schedule_stats": self.scheduler.get_schedule_stats(),
+            "monitor_error_f": round(self.monitor.error, 1),
+            "monitor_error_exceeded": self.monitor.is_in_error_state(),
+        }
+        if self.energy_meter is not None:
+            state.update(self.energy_meter.get_state())
+        if self.zone_biases is not None:
+            state["zone_throttle_percent"] = list(self.throttle_interface.granted_duties)
+            state["zone_peak_load"] = round(self.throttle_interface.peak_load, 1)
+            state["zone_budget_limited_seconds"] = int(self.throttle_interface.budget_limited_seconds)
+        return state
 
     def shutdown(self):
-        self.throttle_interface.shutdown()
+        # Flag the kiln and zero its throttle before the relay is released, so nothing still ticking it can switch
+        # the relay back on
+        self.is_shutdown = True
         self.pi_controller.shutdown()
+        self.set_throttle(0)
+        self.throttle_interface.shutdown()
+        if self.energy_meter is not None:
+            self.energy_meter.update()  # Count the last on period
         self.scheduler.shutdown()
-        self.is_shutdown = True
+        self.dump_trace()
+
+    def dump_trace(self, *args):
+        # Extra args allow use as a signal handler
+        if self.trace_file is not None:
+            TRACER.dump(self.trace_file)
+
+    def get_status_text(self):
+        text = "==========================================================\n"
+        text += "Kiln Controller" + ("" if self.standalone else " - " + self.name) + "\n\n"
+        text += "State: " + ("RUNNING\n" if not self.is_shutdown else "SHUTDOWN\n")
+        text += "Elapsed Runtime: " + str(datetime.now() - self.start_time).split('.')[0] + "\n"
+        text += "Highest Achieved Temp: " + str(round(self.highest_achieved_temp, 1)) + "F\n"
+        text += "Ambient Temperature: " + str(round(self.cold_junc_temp_f, 1)) + "F\n\n"
+        text += self.scheduler.get_schedule_stats()
+        text += "\nThermocouple Temperature: " + str(round(self.thermocouple_temp_f, 1)) + "F\n"
+        text += "Target Temperature: " + str(round(self.setpoint_f, 1)) + "F\n"
+        text += "Error: " + str(round(self.pi_controller.error, 1)) + "F\n"
+        text += "Throttle: " + str(round(self.throttle_percent, 1)) + "%\n\n"
+        if self.zone_biases is not None:
+            text += self.throttle_interface.get_stats() + "\n"
+        if self.energy_meter is not None:
+            text += self.energy_meter.get_stats() + "\n"
+        text += "Monitor - Is Temp Error Exceeded? : " + \
+                ("YES ERROR EXCEEDED" if self.monitor.is_in_error_state() else "NO")
+        text += "\n\n"
+        text += self.pi_controller.get_values(2) + "\n"
+        text += "==========================================================\n"
+        return text
+
+    def open_log(self):
+        # Append to the existing log when resuming a firing
+        return open(self.log_file, 'a' if self.resumed else 'w')
+
+    def write_log_row(self, writer):
+        row = ["Temp", round(self.thermocouple_temp_f, 1), "Tgt", round(self.setpoint_f, 1), "Tht",
+               round(self.throttle_percent, 1), "P", round(self.pi_controller.p_value, 1), "I",
+               round(self.pi_controller.i_value, 1), "Step", self.scheduler.get_schedule_index() + 1, "Time",
+               int(time.time())]
+        if self.energy_meter is not None:
+            row += ["kWh", round(self.energy_meter.energy_kwh, 3), "Cost", round(self.energy_meter.get_cost(), 2)]
+        writer.writerow(row)
 
     def run(self):
-        with open("kiln.csv", 'w') as file:
+        with self.open_log() as file:
             writer = csv.writer(file)
             while True:
-                text = "==========================================================\n"
-                text += "Kiln Controller\n\n"
-                text += "State: " + ("RUNNING\n" if not self.is_shutdown else "SHUTDOWN\n")
-                text += "Elapsed Runtime: " + str(datetime.now() - self.start_time).split('.')[0] + "\n"
-                text += "Highest Achieved Temp: " + str(round(self.highest_achieved_temp, 1)) + "F\n"
-                text += "Ambient Temperature: " + str(round(self.cold_junc_temp_f, 1)) + "F\n\n"
-                text += self.scheduler.get_schedule_stats()
-                text += "\nThermocouple Temperature: " + str(round(self.thermocouple_temp_f, 1)) + "F\n"
-                text += "Target Temperature: " + str(round(self.setpoint_f, 1)) + "F\n"
-                text += "Error: " + str(round(self.pi_controller.error, 1)) + "F\n"
-                text += "Throttle: " + str(round(self.throttle_percent, 1)) + "%\n\n"
-                text += "Monitor - Is Temp Error Exceeded? : " + \
-                        ("YES ERROR EXCEEDED" if self.monitor.is_in_error_state() else "NO")
-                text += "\n\n"
-                text += self.pi_controller.get_values(2) + "\n"
-                text += "==========================================================\n"
-                self.stdscr.erase()
-                self.stdscr.addstr(0, 0, text)
-                self.stdscr.refresh()
+                if self.energy_meter is not None:
+                    self.energy_meter.update()
+                if self.stdscr is not None:
+                    self.stdscr.erase()
+                    self.stdscr.addstr(0, 0, self.get_status_text())
+                    self.stdscr.refresh()
                 if self.file_write_interval == 10:
                     self.file_write_interval = 0
-                    writer.writerow(
-                        ["Temp", round(self.thermocouple_temp_f, 1), "Tgt", round(self.setpoint_f, 1), "Tht",
-                         round(self.throttle_percent, 1), "P", round(self.pi_controller.p_value, 1), "I",
-                         round(self.pi_controller.i_value, 1)])
+                    self.write_log_row(writer)
+                    if self.metrics_file is not None:
+                        REGISTRY.write_file(self.metrics_file)
                 else:
                     self.file_write_interval += 1
                 time.sleep(1)
 
 
 if __name__ == "__main__":
-    kiln = Kiln()
+    parser = argparse.ArgumentParser(description="Kiln Controller")
+    parser.add_argument("--resume", action="store_true", help="Resume a crashed firing from its checkpoint")
+    parser.add_argument("--schedule", help="Schedule file (.json or .toml) to load the firing program from")
+    parser.add_argument("--program", default="default", help="Program name in the schedule file")
+    parser.add_argument("--backend", default="real", choices=sorted(hardware.BACKENDS),
+                        help="Hardware backend for the thermocouple and relay")
+    parser.add_argument("--headless", action="store_true", help="Run without the curses screen")
+    parser.add_argument("--spi-file", help="SPI recording file for the record and replay backends")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="Replay speed relative to the recording, 0 for as fast as possible")
+    parser.add_argument("--element-watts", type=float, help="Element power, enables energy accounting")
+    parser.add_argument("--supply-voltage", type=float, help="Measured supply voltage (elements rated at 240V)")
+    parser.add_argument("--cost-per-kwh", type=float, default=0.0, help="Electricity price for the cost estimate")
+    args = parser.parse_args()
+
+    options = None
+    if args.backend == "record":
+        options = {"path": args.spi_file}
+    elif args.backend == "replay":
+        options = {"path": args.spi_file, "speed": args.replay_speed}
+    if options is not None and args.spi_file is None:
+        parser.error("--backend " + args.backend + " needs --spi-file")
+
+    kiln = Kiln(resume=args.resume, schedule_file=args.schedule, program=args.program, backend=args.backend,
+                backend_options=options, headless=args.headless, element_watts=args.element_watts,
+                supply_voltage=args.supply_voltage, cost_per_kwh=args.cost_per_kwh)
+    signal.signal(signal.SIGUSR1, kiln.dump_trace)  # kill -USR1 <pid> to write the trace file mid-firing
     kiln.run()
@@ -0,0 +1,373 @@
+import argparse
+import csv
+import json
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+from kiln import Kiln
+from metrics import REGISTRY
+from tracer import TRACER
+
+# Trace events the executive records per kiln per control period, for sizing its trace buffer
+EXECUTIVE_TRACE_EVENTS_PER_KILN = 4
+
+
+def safety_shutdown(kiln, reason):
+    """
+    Shuts down a single kiln after an error in its control path, without touching any other kiln.
+    Falls back to forcing the relay off if the normal shutdown itself fails.
+    """
+    print("KilnManager: Shutting down kiln '" + kiln.name + "' - " + reason)
+    try:
+        kiln.shutdown()
+    except Exception as e:
+        print("KilnManager: Error during shutdown of kiln '" + kiln.name + "' (" + str(e) + "). Forcing relay off")
+        try:
+            kiln.throttle_interface.set_throttle(0)
+            kiln.throttle_interface._set_relay(False)
+        except Exception:
+            pass
+        kiln.is_shutdown = True
+
+
+class AcquisitionBus:
+    """
+    Reads every kiln's MAX31856 from a single thread. Reads are spread evenly across the period so chip selects on
+    the shared bus never contend and the load on the Pi stays flat.
+    """
+
+    def __init__(self, kilns, period=1, read_error_callback=None):
+        """
+        :param read_error_callback: Called as (kiln, reason) when a kiln's read fails. The kiln is left for the
+        control thread to shut down, as only that thread may touch a kiln it is ticking
+        """
+        self.kilns = kilns
+        self.period = period
+        self.read_error_callback = read_error_callback
+
+        self.bus_thread = None
+        self._bus_thread_flag = False
+        self.bus_thread_running = False
+
+        self._loop_timer = REGISTRY.loop_timer("kiln_manager_acquisition_loop", period)
+        self._read_errors = REGISTRY.counter("kiln_manager_acquisition_errors_total",
+                                             "Thermocouple reads that raised an error")
+
+    def start_bus_thread(self):
+        if not self.bus_thread_running:
+            self._bus_thread_flag = True
+            self.bus_thread = threading.Thread(group=None, target=self._run, name="acquisition_bus_thread")
+            self.bus_thread.start()
+            return True
+        else:
+            print("AcquisitionBus: Tried to start bus thread, but thread is already running!")
+            return False
+
+    def _run(self):
+        self.bus_thread_running = True
+        TRACER.scale_thread_buffer(len(self.kilns))  # One read span per kiln per period
+        slot = self.period / max(1, len(self.kilns))
+        next_read = time.monotonic()
+        while self._bus_thread_flag:
+            self._loop_timer.tick()
+            for kiln in self.kilns:
+                # Keep reading shut down kilns too, so their temperature stays visible while they cool
+                try:
+                    kiln.max_controller.read_temperatures()
+                except Exception as e:
+                    self._read_errors.value += 1
+                    if not kiln.is_shutdown and self.read_error_callback is not None:
+                        self.read_error_callback(kiln, "thermocouple read failed (" + str(e) + ")")
+
+                next_read += slot
+                delay = next_read - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind - don't try to catch up with a burst of reads
+                    next_read = time.monotonic()
+
+        self.bus_thread_running = False
+
+    def stop_bus_thread(self):
+        self._bus_thread_flag = False
+        # wait for thread to shutdown
+        while self.bus_thread_running:
+            time.sleep(0.1)
+
+
+class ControlExecutive:
+    """
+    Runs the scheduler, PI controller and monitor of every kiln once per control period, and switches every
+    kiln's relay at its burst window edges, all from a single thread.
+
+    Each kiln is ticked inside its own error guard: an error in one kiln shuts that kiln down and the others keep
+    firing.
+    """
+
+    def __init__(self, kilns, control_period=1):
+        self.kilns = kilns
+        self.control_period = control_period
+
+        self.executive_thread = None
+        self._executive_thread_flag = False
+        self.executive_thread_running = False
+
+        # Kiln -> reason, for shutdowns requested from other threads. Carried out on the executive thread
+        self._shutdown_requests = {}
+
+        self._loop_timer = REGISTRY.loop_timer("kiln_manager_control_loop", control_period)
+        self._tick_time = REGISTRY.histogram("kiln_manager_control_tick_seconds",
+                                             "Time to run one control tick across all kilns")
+
+    def start_executive_thread(self):
+        if not self.executive_thread_running:
+            self._executive_thread_flag = True
+            self.executive_thread = threading.Thread(group=None, target=self._run, name="control_executive_thread")
+            self.executive_thread.start()
+            return True
+        else:
+            print("ControlExecutive: Tried to start executive thread, but thread is already running!")
+            return False
+
+    def request_shutdown(self, kiln, reason):
+        """
+        Shuts a kiln down from the executive thread, before it is ticked again. Safe to call from any thread
+        """
+        self._shutdown_requests.setdefault(kiln, reason)
+
+    def _run(self):
+        self.executive_thread_running = True
+        # Scheduler, PI and monitor spans per kiln per period, plus relay edges
+        TRACER.scale_thread_buffer(EXECUTIVE_TRACE_EVENTS_PER_KILN * len(self.kilns))
+        next_control = time.monotonic()
+        while self._executive_thread_flag:
+            for kiln in list(self._shutdown_requests):
+                reason = self._shutdown_requests.pop(kiln)
+                if not kiln.is_shutdown:
+                    safety_shutdown(kiln, reason)
+
+            now = time.monotonic()
+            if now >= next_control:
+                self._loop_timer.tick()
+                for kiln in self.kilns:
+                    # Each kiln starts control as soon as its own first valid reading arrives
+                    if not kiln.is_shutdown and kiln.max_controller.first_sample_event.is_set():
+                        self._control_tick(kiln)
+                self._tick_time.observe(time.monotonic() - now)
+                next_control += self.control_period
+                if next_control < now:
+                    next_control = now + self.control_period
+
+            # Switch relays and sleep until the next relay edge or control tick
+            delay = next_control - time.monotonic()
+            for kiln in self.kilns:
+                if not kiln.is_shutdown:
+                    try:
+                        delay = min(delay, kiln.throttle_interface.tick())
+                    except Exception as e:
+                        safety_shutdown(kiln, "relay switching failed (" + str(e) + ")")
+            if delay > 0:
+                time.sleep(delay)
+
+        for kiln in self.kilns:
+            if not kiln.is_shutdown:
+                kiln.set_throttle(0)
+                kiln.throttle_interface._set_relay(False)
+        self.executive_thread_running = False
+
+    def _control_tick(self, kiln):
+        try:
+            if not kiln.scheduler.tick():
+                return
+            kiln.pi_controller.tick()
+            kiln.monitor.tick()
+            if kiln.energy_meter is not None:
+                kiln.energy_meter.update()
+        except Exception as e:
+            safety_shutdown(kiln, "control tick failed (" + str(e) + ")")
+
+    def stop_executive_thread(self):
+        self._executive_thread_flag = False
+        # wait for thread to shutdown
+        while self.executive_thread_running:
+            time.sleep(0.1)
+
+
+class KilnManager:
+    """
+    Runs several kilns from one process. Every kiln has its own SPI chip select, relay pin, schedule, log and
+    safety monitor, but they share one acquisition thread and one control thread, so the thread count and CPU
+    use stay flat as kilns are added.
+
+    Config file format:
+
+        {
+            "telemetry_port": 8080,
+            "kilns": [
+                {"name": "big", "spi_device": 0, "relay_pin": 36, "schedule_file": "schedules.json",
+                 "program": "default", "log_file": "big.csv", "checkpoint_file": "big_checkpoint.json",
+                 "element_watts": 11500, "cost_per_kwh": 0.15},
+                {"name": "test", "spi_device": 1, "relay_pin": 38, "log_file": "test.csv",
+                 "checkpoint_file": "test_checkpoint.json"}
+            ]
+        }
+
+    Each kiln entry takes the Kiln constructor arguments. 'name', 'spi_device' and 'relay_pin' (or 'zones') are
+    required, and log_file/checkpoint_file default to <name>.csv and <name>_checkpoint.json.
+    """
+
+    def __init__(self, kiln_configs, telemetry_port=8080, metrics_file=None, trace_file=None, resume=False,
+                 headless=False):
+        kiln_configs = [dict(config) for config in kiln_configs]
+        for config in kiln_configs:
+            for key in ("name", "spi_device", "relay_pin"):
+                if key not in config and not (key == "relay_pin" and config.get("zones")):
+                    raise ValueError("KilnManager: Every kiln needs a '" + key + "'")
+            # Per kiln files default from the kiln name so kilns never overwrite each other's log or checkpoint
+            config.setdefault("log_file", config["name"] + ".csv")
+            config.setdefault("checkpoint_file", config["name"] + "_checkpoint.json")
+        for key in ("name", "relay_pin", "log_file", "checkpoint_file", "spi"):
+            if key == "spi":
+                values = [(config.get("spi_bus", 0), config["spi_device"]) for config in kiln_configs]
+            elif key == "relay_pin":
+                values = [pin for config in kiln_configs for pin in
+                          ([zone["relay_pin"] for zone in config["zones"]] if config.get("zones")
+                           else [config["relay_pin"]])]
+            else:
+                values = [config[key] for config in kiln_configs if config[key] is not None]
+            if len(set(values)) != len(values):
+                raise ValueError("KilnManager: Kilns can not share a '" + key + "'")
+
+        self.trace_file = trace_file
+        if trace_file is not None:
+            TRACER.enable()
+        self.metrics_file = metrics_file
+
+        self.kilns = []
+        for config in kiln_configs:
+            config = dict(config, standalone=False, telemetry_port=None, metrics_file=None, trace_file=None)
+            config.setdefault("resume", resume)
+            self.kilns.append(Kiln(**config))
+
+        self.control_executive = ControlExecutive(self.kilns)
+        self.acquisition_bus = AcquisitionBus(self.kilns, read_error_callback=self.control_executive.request_shutdown)
+
+        self.telemetry_server = None
+        if telemetry_port is not None:
+            from telemetry_server import TelemetryServer, HISTORY_FIELDS
+            history_fields = [kiln.name + "." + field for kiln in self.kilns for field in HISTORY_FIELDS]
+            self.telemetry_server = TelemetryServer(self.get_state, port=telemetry_port,
+                                                    history_fields=history_fields)
+
+        self.start_time = datetime.now()
+        self.headless = headless
+        self.stdscr = None
+
+    @classmethod
+    def from_config(cls, path, resume=False, headless=False):
+        with open(path) as file:
+            config = json.load(file)
+        return cls(config["kilns"], config.get("telemetry_port", 8080), config.get("metrics_file"),
+                   config.get("trace_file"), resume, headless)
+
+    def start(self):
+        self.acquisition_bus.start_bus_thread()
+        self.control_executive.start_executive_thread()
+        if self.telemetry_server is not None:
+            self.telemetry_server.start_server_thread()
+
+    def shutdown(self):
+        # Stop the executive first, so it can't tick a kiln (and switch its relay back on) while it shuts down
+        self.control_executive.stop_executive_thread()
+        self.acquisition_bus.stop_bus_thread()
+        for kiln in self.kilns:
+            if not kiln.is_shutdown:
+                safety_shutdown(kiln, "manager shutdown")
+        self.dump_trace()
+
+    def dump_trace(self, *args):
+        # Extra args allow use as a signal handler
+        if self.trace_file is not None:
+            TRACER.dump(self.trace_file)
+
+    def get_state(self):
+        """
+        :return: Flat dict of every kiln's state, keyed "<kiln name>.<field>"
+        """
+        state = {"time": time.time(), "kilns": ",".join(kiln.name for kiln in self.kilns),
+                 "running_kilns": sum(1 for kiln in self.kilns if not kiln.is_shutdown)}
+        for kiln in self.kilns:
+            for key, value in kiln.get_state().items():
+                if key != "time":
+                    state[kiln.name + "." + key] = value
+        return state
+
+    def get_status_text(self):
+        text = "==========================================================\n"
+        text += "Kiln Manager - " + str(len(self.kilns)) + " kilns\n"
+        text += "Elapsed Runtime: " + str(datetime.now() - self.start_time).split('.')[0] + "\n\n"
+        text += "{:<12} {:<9} {:>8} {:>8} {:>7} {:>6} {:>7} {:>7}\n".format("Kiln", "State", "Temp F", "Tgt F",
+                                                                            "Tht %", "Step", "Monitor", "kWh")
+        for kiln in self.kilns:
+            step = str(kiln.scheduler.get_schedule_index() + 1) + "/" + str(len(kiln.scheduler.schedule))
+            energy = "-" if kiln.energy_meter is None else round(kiln.energy_meter.energy_kwh, 2)
+            text += "{:<12} {:<9} {:>8} {:>8} {:>7} {:>6} {:>7} {:>7}\n".format(
+                kiln.name[:12], "RUNNING" if not kiln.is_shutdown else "SHUTDOWN",
+                round(kiln.thermocouple_temp_f, 1), round(kiln.setpoint_f, 1), round(kiln.throttle_percent, 1),
+                step, "ERROR" if kiln.monitor.is_in_error_state() else "OK", energy)
+        text += "==========================================================\n"
+        return text
+
+    def run(self):
+        if not self.headless:
+            import curses
+            self.stdscr = curses.initscr()
+            curses.curs_set(False)
+            self.stdscr.clear()
+            self.stdscr.refresh()
+        self.start()
+
+        files = [kiln.open_log() for kiln in self.kilns]
+        writers = [csv.writer(file) for file in files]
+        file_write_interval = 0
+        try:
+            while True:
+                if self.stdscr is not None:
+                    self.stdscr.erase()
+                    self.stdscr.addstr(0, 0, self.get_status_text())
+                    self.stdscr.refresh()
+                if file_write_interval == 10:
+                    file_write_interval = 0
+                    for kiln, writer, file in zip(self.kilns, writers, files):
+                        kiln.write_log_row(writer)
+                        file.flush()
+                    if self.metrics_file is not None:
+                        REGISTRY.write_file(self.metrics_file)
+                else:
+                    file_write_interval += 1
+                time.sleep(1)
+        finally:
+            # Ctrl-C, SIGTERM or an error here must not leave the shared threads switching relays unattended
+            self.shutdown()
+            for file in files:
+                file.close()
+
+    def terminate(self, *args):
+        # SIGTERM handler - exits run() through its finally, which shuts every kiln down
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several kilns from one process")
+    parser.add_argument("config", help="Kiln manager config file (JSON)")
+    parser.add_argument("--resume", action="store_true", help="Resume every kiln from its checkpoint")
+    parser.add_argument("--headless", action="store_true", help="Run without the curses screen")
+    args = parser.parse_args()
+
+    manager = KilnManager.from_config(args.config, args.resume, args.headless)
+    signal.signal(signal.SIGUSR1, manager.dump_trace)  # kill -USR1 <pid> to write the trace file mid-firing
+    signal.signal(signal.SIGTERM, manager.terminate)
+    manager.run()
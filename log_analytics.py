@@ -0,0 +1,407 @@
+"""
+Analyses a directory of firing logs (the kiln.csv files written by Kiln/KilnManager), one firing per file.
+
+    python log_analytics.py logs/
+    python log_analytics.py logs/ --segments --workers 4
+
+Per firing and per schedule segment it reports tracking error, overshoot after a ramp settles into a hold, time
+with the throttle saturated at 0% and 100%, time with the PI integrator at its +-100 clamp, and the achieved vs
+requested ramp rate. Then the trends of those across firings, in date order (ie. rising time at 100% throttle as
+elements age).
+
+Files are parsed as streams on a process pool, and results are cached in the directory keyed by file size and
+modification time, so a rerun only parses new or changed logs.
+
+Logs from before rows carried 'Step' and 'Time' fields are split into segments from the setpoint movement and
+timed at the nominal row interval.
+"""
+import argparse
+import concurrent.futures
+import csv
+import json
+import math
+import os
+import sys
+
+CACHE_FILE = ".kiln_analytics_cache.json"
+
+# Bump when the analysis or result format changes, to invalidate old cache entries
+ANALYSIS_VERSION = 1
+
+# Kiln.run writes a row every 11 loops of 1 second - used when rows have no 'Time'
+LOG_ROW_SECONDS = 11
+
+# A longer gap between rows is downtime (ie. a crash before a resume) and counts as one row interval
+MAX_ROW_GAP_SECONDS = 300
+
+# PIController clamps its integrator here
+INTEGRATOR_LIMIT = 100
+
+# Setpoint slopes below this are holds, F per hour
+HOLD_RATE_F_PER_HOUR = 5
+
+# Rows a setpoint trend must persist for to start a new segment, for logs without 'Step'
+SEGMENT_CONFIRM_ROWS = 3
+
+
+def _read_rows(path):
+    # Streams key/value rows ("Temp", 1200.5, "Tgt", ...) as dicts of floats, skipping rows that don't parse
+    with open(path, newline="") as file:
+        for row in csv.reader(file):
+            fields = {}
+            for key, value in zip(row[0::2], row[1::2]):
+                try:
+                    fields[key] = float(value)
+                except ValueError:
+                    pass
+            if "Temp" in fields and "Tgt" in fields:
+                yield fields
+
+
+class _Segment:
+    # Streaming statistics of one schedule segment
+
+    def __init__(self, number, previous_kind):
+        self.number = number
+        self.previous_kind = previous_kind
+        self.rows = 0
+        self.seconds = 0.0
+        self.start_temp = None
+        self.end_temp = None
+        self.error_sum = 0.0
+        self.error_squares = 0.0
+        self.max_abs_error = 0.0
+        self.max_above_setpoint = -math.inf
+        self.saturated_low_seconds = 0.0
+        self.saturated_high_seconds = 0.0
+        self.integrator_saturated_seconds = 0.0
+        self.start_kwh = None
+        self.end_kwh = None
+        # Least squares sums for the setpoint and temperature slopes against time (hours)
+        self._t = self._tt = self._setpoint = self._t_setpoint = self._temp = self._t_temp = 0.0
+        self._elapsed_hours = 0.0
+
+    def add(self, fields, dt):
+        temp, setpoint = fields["Temp"], fields["Tgt"]
+        error = setpoint - temp
+        # Each row stands for the dt leading up to it
+        self.seconds += dt
+        if self.rows:
+            self._elapsed_hours += dt / 3600
+        else:
+            self.start_temp = temp
+            self.start_kwh = fields.get("kWh")
+        self.rows += 1
+        self.end_temp = temp
+        self.end_kwh = fields.get("kWh", self.end_kwh)
+
+        self.error_sum += error
+        self.error_squares += error * error
+        self.max_abs_error = max(self.max_abs_error, abs(error))
+        self.max_above_setpoint = max(self.max_above_setpoint, -error)
+        throttle = fields.get("Tht", 0)
+        if throttle <= 0:
+            self.saturated_low_seconds += dt
+        if throttle >= 100:
+            self.saturated_high_seconds += dt
+        if abs(fields.get("I", 0)) >= INTEGRATOR_LIMIT:
+            self.integrator_saturated_seconds += dt
+
+        t = self._elapsed_hours
+        self._t += t
+        self._tt += t * t
+        self._setpoint += setpoint
+        self._t_setpoint += t * setpoint
+        self._temp += temp
+        self._t_temp += t * temp
+
+    def _slope(self, total, t_total):
+        variance = self._tt - self._t * self._t / self.rows
+        if self.rows < 2 or variance <= 0:
+            return 0.0
+        return (t_total - self._t * total / self.rows) / variance
+
+    def get_kind(self):
+        rate = self._slope(self._setpoint, self._t_setpoint)
+        if rate > HOLD_RATE_F_PER_HOUR:
+            return "ramp"
+        if rate < -HOLD_RATE_F_PER_HOUR:
+            return "cool"
+        return "hold"
+
+    def get_result(self):
+        kind = self.get_kind()
+        result = {
+            "step": self.number,
+            "kind": kind,
+            "hours": round(self.seconds / 3600, 3),
+            "start_temp_f": self.start_temp,
+            "end_temp_f": self.end_temp,
+            "mean_error_f": round(self.error_sum / self.rows, 2),
+            "rms_error_f": round(math.sqrt(self.error_squares / self.rows), 2),
+            "max_abs_error_f": round(self.max_abs_error, 1),
+            "saturated_0_minutes": round(self.saturated_low_seconds / 60, 1),
+            "saturated_100_minutes": round(self.saturated_high_seconds / 60, 1),
+            "integrator_saturated_minutes": round(self.integrator_saturated_seconds / 60, 1),
+            "overshoot_f": None,
+            "requested_rate_f_per_hour": None,
+            "achieved_rate_f_per_hour": None,
+            "kwh": None,
+        }
+        if kind == "hold" and self.previous_kind == "ramp":
+            result["overshoot_f"] = round(max(self.max_above_setpoint, 0.0), 1)
+        if kind != "hold":
+            result["requested_rate_f_per_hour"] = round(self._slope(self._setpoint, self._t_setpoint), 1)
+            result["achieved_rate_f_per_hour"] = round(self._slope(self._temp, self._t_temp), 1)
+        if self.start_kwh is not None and self.end_kwh is not None:
+            result["kwh"] = round(self.end_kwh - self.start_kwh, 3)
+        return result
+
+
+def _setpoint_trend(delta):
+    if delta > 0:
+        return "ramp"
+    if delta < 0:
+        return "cool"
+    return "hold"
+
+
+def analyze_firing(path):
+    """
+    Analyses one firing log in a single pass
+    :return: Dict of firing statistics with a list of per segment dicts, or None if the log has no firing rows or
+    can't be read (ie. a stray binary file named .csv), so one bad file doesn't abort a directory
+    """
+    try:
+        return _analyze_firing(path)
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        print("LogAnalytics: Skipping " + path + " - " + str(e))
+        return None
+
+
+def _analyze_firing(path):
+    segments = []
+    segment = None
+    firing = _Segment(0, None)
+    last_time = None
+    last_setpoint = None
+    start_time = None
+    max_temp = -math.inf
+    kwh = None
+    # Logs without step numbers: setpoint trend of the current segment, and rows of a possible new trend
+    current_trend = None
+    pending_trend, pending_rows = None, []
+
+    for fields in _read_rows(path):
+        # Setpoint 0 is before the first scheduler tick or after the schedule completed
+        if fields["Tgt"] <= 0:
+            last_setpoint = None
+            continue
+
+        row_time = fields.get("Time")
+        if row_time is None:
+            row_time = (last_time or 0) + LOG_ROW_SECONDS
+        dt = LOG_ROW_SECONDS if last_time is None else row_time - last_time
+        if dt < 0 or dt > MAX_ROW_GAP_SECONDS:
+            dt = LOG_ROW_SECONDS
+        last_time = row_time
+        if start_time is None and "Time" in fields:
+            start_time = row_time
+        max_temp = max(max_temp, fields["Temp"])
+        kwh = fields.get("kWh", kwh)
+        firing.add(fields, dt)
+
+        if "Step" in fields:
+            if segment is None or fields["Step"] != segment.number:
+                previous_kind = segment.get_kind() if segment is not None else None
+                segment = _Segment(int(fields["Step"]), previous_kind)
+                segments.append(segment)
+            segment.add(fields, dt)
+        else:
+            # No step numbers - start a new segment once the setpoint trend has changed for a few rows
+            trend = None if last_setpoint is None else _setpoint_trend(round(fields["Tgt"] - last_setpoint, 1))
+            last_setpoint = fields["Tgt"]
+            if segment is None:
+                segment = _Segment(1, None)
+                segments.append(segment)
+            if current_trend is None:
+                current_trend = trend
+            if trend is None or trend == current_trend:
+                pending_rows.append((fields, dt))
+                for pending_fields, pending_dt in pending_rows:
+                    segment.add(pending_fields, pending_dt)
+                pending_trend, pending_rows = None, []
+                continue
+            if trend != pending_trend:
+                for pending_fields, pending_dt in pending_rows:
+                    segment.add(pending_fields, pending_dt)
+                pending_trend, pending_rows = trend, []
+            pending_rows.append((fields, dt))
+            if len(pending_rows) >= SEGMENT_CONFIRM_ROWS:
+                segment = _Segment(segment.number + 1, segment.get_kind())
+                segments.append(segment)
+                for pending_fields, pending_dt in pending_rows:
+                    segment.add(pending_fields, pending_dt)
+                current_trend, pending_trend, pending_rows = trend, None, []
+
+    if segment is not None:
+        for pending_fields, pending_dt in pending_rows:
+            segment.add(pending_fields, pending_dt)
+    if not firing.rows:
+        return None
+
+    segment_results = [segment.get_result() for segment in segments]
+    overshoots = [result["overshoot_f"] for result in segment_results if result["overshoot_f"] is not None]
+    ratios = [result["achieved_rate_f_per_hour"] / result["requested_rate_f_per_hour"]
+              for result in segment_results if result["kind"] == "ramp" and result["requested_rate_f_per_hour"]]
+    hours = firing.seconds / 3600
+    return {
+        "file": path,
+        "start_time": start_time if start_time is not None else os.path.getmtime(path) - firing.seconds,
+        "hours": round(hours, 2),
+        "max_temp_f": round(max_temp, 1),
+        "mean_error_f": round(firing.error_sum / firing.rows, 2),
+        "rms_error_f": round(math.sqrt(firing.error_squares / firing.rows), 2),
+        "max_abs_error_f": round(firing.max_abs_error, 1),
+        "max_overshoot_f": max(overshoots) if overshoots else None,
+        "saturated_0_percent": round(100 * firing.saturated_low_seconds / firing.seconds, 1) if firing.seconds else 0,
+        "saturated_100_percent": round(100 * firing.saturated_high_seconds / firing.seconds, 1) if firing.seconds
+        else 0,
+        "integrator_saturated_percent": round(100 * firing.integrator_saturated_seconds / firing.seconds, 1)
+        if firing.seconds else 0,
+        "min_ramp_rate_ratio": round(min(ratios), 2) if ratios else None,
+        "kwh": kwh,
+        "segments": segment_results,
+    }
+
+
+def _find_logs(directory):
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(".csv"):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def _load_cache(path):
+    try:
+        with open(path) as file:
+            cache = json.load(file)
+        if cache.get("version") == ANALYSIS_VERSION:
+            return cache["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def _write_cache(path, files):
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w") as file:
+            json.dump({"version": ANALYSIS_VERSION, "files": files}, file)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print("LogAnalytics: Could not write cache - " + str(e))
+
+
+def analyze_directory(directory, workers=None, use_cache=True):
+    """
+    Analyses every .csv firing log below a directory, reusing cached results for unchanged files
+    :param workers: Worker processes. None uses one per CPU
+    :return: List of firing results in date order
+    """
+    cache_path = os.path.join(directory, CACHE_FILE)
+    cached = _load_cache(cache_path) if use_cache else {}
+    files = {}
+    stale = []
+    for path in _find_logs(directory):
+        stat = os.stat(path)
+        key = os.path.relpath(path, directory)
+        entry = cached.get(key)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            files[key] = entry
+        else:
+            files[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "result": None}
+            stale.append(key)
+
+    if stale:
+        paths = [os.path.join(directory, key) for key in stale]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            for key, result in zip(stale, pool.map(analyze_firing, paths)):
+                files[key]["result"] = result
+        if use_cache:
+            _write_cache(cache_path, files)
+
+    firings = [entry["result"] for entry in files.values() if entry["result"] is not None]
+    return sorted(firings, key=lambda firing: firing["start_time"])
+
+
+def get_trends(firings, fields=("rms_error_f", "max_overshoot_f", "saturated_100_percent",
+                                "integrator_saturated_percent", "min_ramp_rate_ratio", "kwh")):
+    """
+    Least squares trend of each field across firings in date order
+    :return: Dict of field -> {"first", "last", "per_firing", "firings"}, for fields with at least two values
+    """
+    trends = {}
+    for field in fields:
+        values = [firing[field] for firing in firings if firing.get(field) is not None]
+        if len(values) < 2:
+            continue
+        count = len(values)
+        mean_x = (count - 1) / 2
+        mean_y = sum(values) / count
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values)) / \
+            sum((x - mean_x) ** 2 for x in range(count))
+        trends[field] = {"first": values[0], "last": values[-1], "per_firing": round(slope, 3), "firings": count}
+    return trends
+
+
+def _cell(value):
+    return "-" if value is None else value
+
+
+def format_report(firings, trends, segments=False):
+    text = "{:<28} {:>7} {:>8} {:>7} {:>7} {:>9} {:>7} {:>7} {:>7} {:>6} {:>8}\n".format(
+        "Firing", "Hours", "Max F", "RMS F", "Max|e|", "Overshoot", "Sat0 %", "Sat100%", "ISat %", "Rate", "kWh")
+    for firing in firings:
+        text += "{:<28} {:>7} {:>8} {:>7} {:>7} {:>9} {:>7} {:>7} {:>7} {:>6} {:>8}\n".format(
+            os.path.basename(firing["file"])[-28:], firing["hours"], firing["max_temp_f"], firing["rms_error_f"],
+            firing["max_abs_error_f"], _cell(firing["max_overshoot_f"]), firing["saturated_0_percent"],
+            firing["saturated_100_percent"], firing["integrator_saturated_percent"],
+            _cell(firing["min_ramp_rate_ratio"]), _cell(firing["kwh"]))
+        if segments:
+            for segment in firing["segments"]:
+                text += "    {:>3} {:<5} {:>6}h {:>7} -> {:<7} rms {:>6} max {:>6} over {:>5} sat0 {:>6}m " \
+                        "sat100 {:>6}m isat {:>6}m rate {:>7}/{}\n".format(
+                            segment["step"], segment["kind"], segment["hours"], segment["start_temp_f"],
+                            segment["end_temp_f"], segment["rms_error_f"], segment["max_abs_error_f"],
+                            _cell(segment["overshoot_f"]), segment["saturated_0_minutes"],
+                            segment["saturated_100_minutes"], segment["integrator_saturated_minutes"],
+                            _cell(segment["achieved_rate_f_per_hour"]), _cell(segment["requested_rate_f_per_hour"]))
+    if trends:
+        text += "\nTrends across firings (first -> last, least squares change per firing):\n"
+        for field, trend in trends.items():
+            text += "    {:<30} {:>8} -> {:<8} {:+}\n".format(field, trend["first"], trend["last"],
+                                                             trend["per_firing"])
+    return text
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse a directory of kiln firing logs")
+    parser.add_argument("directory", help="Directory searched for .csv firing logs")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--segments", action="store_true", help="Also list every segment of every firing")
+    parser.add_argument("--no-cache", action="store_true", help="Reparse every log and don't write the cache")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print("Not a directory: " + args.directory)
+        sys.exit(2)
+    results = analyze_directory(args.directory, args.workers, not args.no_cache)
+    result_trends = get_trends(results)
+    if args.json:
+        print(json.dumps({"firings": results, "trends": result_trends}, indent=2))
+    else:
+        print(format_report(results, result_trends, args.segments))
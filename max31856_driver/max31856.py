@@ -4,13 +4,23 @@
 
 # Functionality that is currently unimplemented:
 # - Helper function for setting the Fault Mask Register
-import spidev
+import time
+from metrics import REGISTRY
 
 
 class Max31856:
-    def __init__(self, spi: spidev):
+    def __init__(self, spi, labels=None):
+        """
+        :param spi: Open spidev.SpiDev (or any object with a compatible xfer2) connected to the max31856_driver
+        :param labels: Metric labels identifying this device
+        """
         self.spi = spi
 
+        # Instrumentation
+        self._spi_transactions = REGISTRY.counter("kiln_spi_transactions_total", "SPI xfer2 transactions", labels)
+        self._spi_latency = REGISTRY.histogram("kiln_spi_transaction_seconds", "SPI xfer2 transaction latency",
+                                               labels=labels)
+
         # Configuration Register 1 Parameters
         self.config1_conversion_mode = 1  # 0 = off, 1 = auto conversion every 100ms
         self.config1_oneshot = 0  # 0 = Off, 1 = conversion on chip select when conv. mode is set off
@@ -19,6 +29,11 @@ class Max31856:
         self.config1_fault_mode = 0  # 0 = fault bits high only when fault active, 1 = latched faults
         self.config1_hz_filter_mode = 0  # 0 = 60hz, 1 = 50hz
 
+        # Until the first conversion after a configuration write completes, the temperature registers still hold
+        # their power on value (0C)
+        self.averaging_samples = 1
+        self.conversion_ready_time = 0
+
         # Set the thermocouple mode defaults and configuration register defaults
         self.set_thermocouple_mode("K", 16)
         self.write_config_reg_1()
@@ -48,7 +63,10 @@ class Max31856:
             print("max31856_driver Error: Byte Address out of range.")
             return
         data_bytes = [0x80 + address, data]
+        start = time.perf_counter()
         self.spi.xfer2(data_bytes)
+        self._spi_latency.observe(time.perf_counter() - start)
+        self._spi_transactions.value += 1
 
     def read_data(self, address, number_of_bytes):
         """
@@ -67,7 +85,10 @@ class Max31856:
             address_bytes.append(0x00)
 
         # Simultaneously send and receive bytes
+        start = time.perf_counter()
         received_bytes = self.spi.xfer2(address_bytes)
+        self._spi_latency.observe(time.perf_counter() - start)
+        self._spi_transactions.value += 1
 
         # The first byte received will be empty since we are sending an address during the first byte. Discard
         received_bytes = received_bytes[1:]
@@ -100,6 +121,7 @@ class Max31856:
 
         # Write to the config register
         self.write_data(0x00, config_data)
+        self.conversion_ready_time = time.monotonic() + self.get_first_conversion_seconds()
 
     def set_thermocouple_mode(self, thermocouple_type_string: str, averaging_samples: int):
         """
@@ -145,7 +167,24 @@ class Max31856:
             print("max31856_driver Error: Invalid sample averaging value.")
             return
 
+        self.averaging_samples = averaging_samples
         self.write_data(0x01, data_byte)
+        self.conversion_ready_time = time.monotonic() + self.get_first_conversion_seconds()
+
+    def get_first_conversion_seconds(self):
+        """
+        :return: Worst case time for the first averaged conversion after a configuration write, in auto conversion
+        mode (datasheet: 143ms + 33.33ms per extra sample at 60hz, 169ms + 40ms per extra sample at 50hz)
+        """
+        if self.config1_hz_filter_mode:
+            return (169 + 40 * (self.averaging_samples - 1)) / 1000
+        return (143 + 33.33 * (self.averaging_samples - 1)) / 1000
+
+    def is_conversion_ready(self):
+        """
+        :return: True once the temperature registers hold a real conversion, rather than their power on value
+        """
+        return time.monotonic() >= self.conversion_ready_time
 
     def read_cold_junction_temperature(self):
         """
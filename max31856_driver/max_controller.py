@@ -1,27 +1,30 @@
 from max31856_driver import max31856
-import spidev
+import hardware
 import threading
 import time
 from datetime import datetime
+from metrics import REGISTRY, PERIOD_BUCKETS
+from tracer import TRACER
+
+# Args of the spi_read trace span
+TRACE_ARGS = ("thermocouple_c", "cold_junc_c", "fault")
 
 
 class MAXController:
 
-    def __init__(self, kiln, bus_number, device_id, sleep_time):
+    def __init__(self, kiln, bus_number, device_id, sleep_time, labels=None, backend=None):
         self.kiln = kiln
 
-        # Enable SPI
-        spi = spidev.SpiDev()
-
-        # Open connection to bus and device (chip select pin)
-        spi.open(bus_number, device_id)
+        # Open the SPI device through the selected hardware backend (real spidev by default)
+        if backend is None:
+            backend = hardware.get_backend("real")
+        spi = backend.open_spi(bus_number, device_id)
 
-        # Set SPI speed and mode
-        spi.max_speed_hz = 4000000
-        spi.mode = 0b01
-        spi.lsbfirst = False
+        self.max31856 = max31856.Max31856(spi, labels)
 
-        self.max31856 = max31856.Max31856(spi)
+        # Set once the first reading of a completed conversion without a fault has been passed on - control waits
+        # on this
+        self.first_sample_event = threading.Event()
 
         self.spi_thread = None
         self._spi_thread_flag = False
@@ -32,6 +35,14 @@ class MAXController:
         self.cold_junction_temp_callback = None
         self.fault_callback = None
 
+        # Instrumentation
+        self._loop_timer = REGISTRY.loop_timer("kiln_spi_loop", sleep_time, labels)
+        self._fault_count = REGISTRY.counter("kiln_thermocouple_faults_total", "Reads with a MAX31856 fault set",
+                                             labels)
+        self._stop_time = REGISTRY.histogram("kiln_thread_stop_seconds",
+                                             "Time taken for a stop_*_thread call to return", PERIOD_BUCKETS,
+                                             dict(labels or {}, thread="max31856_spi_thread"))
+
     def start_spi_thread(self):
         if not self.spi_thread_running:
             # print("Starting SPI Thread...")
@@ -45,37 +56,73 @@ class MAXController:
 
     def _run(self):
         self.spi_thread_running = True
+        self._loop_timer.reset()
         while self._spi_thread_flag:
-
-            # Read the cold junction temperature
-            cold_junc_temp = self.max31856.read_cold_junction_temperature()
-            if self.cold_junction_temp_callback is not None:
-                self.cold_junction_temp_callback(cold_junc_temp)
-            if self.kiln is not None:
-                self.kiln.set_cold_junc_temp_c(cold_junc_temp)
-
-            # Read the thermocouple temperature
-            thermocouple_temp = self.max31856.read_thermocouple_temperature()
-            if self.thermocouple_temp_callback is not None:
-                self.thermocouple_temp_callback(thermocouple_temp)
-            if self.kiln is not None:
-                self.kiln.set_thermocouple_temp_c(thermocouple_temp)
-
-            # Update any fault statuses
-            self.max31856.read_faults()
-            if self.fault_callback is not None:
-                if self.max31856.has_fault():
-                    self.fault_callback(self)
-
+            self._loop_timer.tick()
+            self.read_temperatures()
             time.sleep(self.sleep_time)
 
         self.spi_thread_running = False
 
+    def read_temperatures(self):
+        """
+        Reads the cold junction temperature, thermocouple temperature and faults once, and passes them to the
+        kiln and callbacks
+        """
+        t0 = TRACER.begin()
+
+        # Read the cold junction temperature
+        cold_junc_temp = self.max31856.read_cold_junction_temperature()
+        if self.cold_junction_temp_callback is not None:
+            self.cold_junction_temp_callback(cold_junc_temp)
+        if self.kiln is not None:
+            self.kiln.set_cold_junc_temp_c(cold_junc_temp)
+
+        # Read the thermocouple temperature
+        thermocouple_temp = self.max31856.read_thermocouple_temperature()
+        if self.thermocouple_temp_callback is not None:
+            self.thermocouple_temp_callback(thermocouple_temp)
+        if self.kiln is not None:
+            self.kiln.set_thermocouple_temp_c(thermocouple_temp)
+
+        # Update any fault statuses
+        self.max31856.read_faults()
+        if self.max31856.has_fault():
+            self._fault_count.value += 1
+            if self.fault_callback is not None:
+                self.fault_callback(self)
+        elif self.max31856.is_conversion_ready():
+            self.first_sample_event.set()
+
+        if t0:
+            TRACER.end("spi_read", t0, TRACE_ARGS, thermocouple_temp, cold_junc_temp, self.max31856.has_fault())
+
+    def read_first_sample(self, timeout=5):
+        """
+        Reads until first_sample_event is set - for code that needs a real temperature before the SPI thread starts
+        (ie. resuming a firing). Waits out the first conversion rather than reading the power on value
+        :param timeout: Seconds to keep trying through faults
+        :return: True if a valid sample was read
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            delay = self.max31856.conversion_ready_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.read_temperatures()
+            if self.first_sample_event.is_set():
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.sleep_time)
+
     def stop_spi_thread(self):
+        start = time.monotonic()
         self._spi_thread_flag = False
         # wait for thread to shutdown
         while self.spi_thread_running:
             time.sleep(0.1)
+        self._stop_time.observe(time.monotonic() - start)
 
 
 def print_thermo_temp(val):
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+PERIOD_BUCKETS = (0.1, 0.5, 0.9, 0.95, 0.99, 1.0, 1.01, 1.05, 1.1, 1.5, 2, 5, 10, 10.1, 10.5, 11, 15)
+JITTER_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Counter:
+    # Metrics are plain slotted objects so recording is a single attribute update on the hot path.
+    # Each metric is only ever written by the one thread that owns it, so no locking is needed.
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket plus the +Inf bucket, preallocated
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class LoopTimer:
+    """
+    Records the actual period of a control loop and its jitter (deviation from the target period).
+    Call tick() once per loop iteration.
+    """
+
+    __slots__ = ("target_period", "period", "jitter", "iterations", "_last")
+
+    def __init__(self, registry, name, target_period, labels=None):
+        self.target_period = target_period
+        self.period = registry.histogram(name + "_period_seconds", "Measured loop period", PERIOD_BUCKETS, labels)
+        self.jitter = registry.histogram(name + "_jitter_seconds", "Absolute deviation from the target loop period",
+                                         JITTER_BUCKETS, labels)
+        self.iterations = registry.counter(name + "_iterations_total", "Loop iterations", labels)
+        self._last = None
+
+    def tick(self):
+        now = time.monotonic()
+        if self._last is not None:
+            period = now - self._last
+            self.period.observe(period)
+            self.jitter.observe(abs(period - self.target_period))
+        self._last = now
+        self.iterations.value += 1
+
+    def reset(self):
+        # Call when a loop restarts so the gap while it was stopped is not counted as a period
+        self._last = None
+
+
+class MetricsRegistry:
+    """
+    Holds all metrics and renders them in the Prometheus text exposition format.
+    Metrics are created once (at component construction) and then updated in place.
+    """
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, metric_type, help_text, labels, factory):
+        label_key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = (metric_type, help_text, {})
+                self._families[name] = family
+            elif family[0] != metric_type:
+                raise ValueError("Metric " + name + " already registered as a " + family[0])
+            metric = family[2].get(label_key)
+            if metric is None:
+                metric = factory()
+                family[2][label_key] = metric
+            return metric
+
+    def counter(self, name, help_text, labels=None):
+        return self._get(name, "counter", help_text, labels, Counter)
+
+    def gauge(self, name, help_text, labels=None):
+        return self._get(name, "gauge", help_text, labels, Gauge)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, labels=None):
+        return self._get(name, "histogram", help_text, labels, lambda: Histogram(buckets))
+
+    def loop_timer(self, name, target_period, labels=None):
+        return LoopTimer(self, name, target_period, labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            families = [(name, family[0], family[1], list(family[2].items()))
+                        for name, family in sorted(self._families.items())]
+        for name, metric_type, help_text, metrics in families:
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+            for label_key, metric in metrics:
+                if metric_type == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (None,), list(metric.counts)):
+                        cumulative += count
+                        le = "+Inf" if bound is None else _format_value(bound)
+                        lines.append(name + "_bucket" + _format_labels(label_key + (("le", le),)) + " " +
+                                     str(cumulative))
+                    lines.append(name + "_sum" + _format_labels(label_key) + " " + _format_value(metric.sum))
+                    lines.append(name + "_count" + _format_labels(label_key) + " " + str(metric.count))
+                else:
+                    lines.append(name + _format_labels(label_key) + " " + _format_value(metric.value))
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path):
+        """
+        Atomically writes the metrics to a file (ie. for the node_exporter textfile collector)
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(self.render())
+        os.replace(tmp_path, path)
+
+
+def _format_labels(label_key):
+    if not label_key:
+        return ""
+    pairs = []
+    for key, value in label_key:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(key + "=\"" + value + "\"")
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# Process-wide default registry
+REGISTRY = MetricsRegistry()
@@ -1,11 +1,16 @@
 import threading
 import time
 from datetime import datetime
+from metrics import REGISTRY, PERIOD_BUCKETS
+from tracer import TRACER
+
+# Args of the monitor_check trace span
+TRACE_ARGS = ("error", "in_error_state")
 
 
 class Monitor:
 
-    def __init__(self, kiln, max_error, max_constant_error, max_constant_error_time_minutes):
+    def __init__(self, kiln, max_error, max_constant_error, max_constant_error_time_minutes, labels=None):
         self.kiln = kiln
         self.max_error = max_error
         self.max_constant_error = max_constant_error
@@ -15,9 +20,19 @@ class Monitor:
         self._monitor_thread_flag = False
         self.monitor_thread_running = False
 
-        self.last_ok_time = datetime.now()
+        # Source of the current time for the constant error limit. A replay benchmark swaps in the recording's clock
+        self.clock = datetime.now
+        self.last_ok_time = self.clock()
         self.error = 0
 
+        # Instrumentation
+        self._loop_timer = REGISTRY.loop_timer("kiln_monitor_loop", 1, labels)
+        self._trip_count = REGISTRY.counter("kiln_monitor_shutdowns_total", "Safety shutdowns triggered by the monitor",
+                                            labels)
+        self._stop_time = REGISTRY.histogram("kiln_thread_stop_seconds",
+                                             "Time taken for a stop_*_thread call to return", PERIOD_BUCKETS,
+                                             dict(labels or {}, thread="monitor_thread"))
+
     def is_in_error_state(self):
         if self.error > self.max_error or self.error > self.max_constant_error:
             return True
@@ -34,27 +49,42 @@ class Monitor:
             return False
 
     def stop_monitor_thread(self):
+        start = time.monotonic()
         self._monitor_thread_flag = False
         while self.monitor_thread_running:
             time.sleep(0.1)
+        self._stop_time.observe(time.monotonic() - start)
 
     def shutdown_kiln(self):
+        self._trip_count.value += 1
         self.kiln.shutdown()
         self._monitor_thread_flag = False
 
+    def tick(self):
+        """
+        Runs one safety check, shutting the kiln down if the error limits are exceeded. Called by the monitor
+        thread, or by the KilnManager control executive when the kiln is managed.
+        """
+        t0 = TRACER.begin()
+        self.error = abs(self.kiln.setpoint_f - self.kiln.thermocouple_temp_f)
+
+        # Shutdown if max error exceeded
+        if self.error > self.max_error:
+            self.shutdown_kiln()
+        # If shutdown exceeds constant error for time limit
+        elif ((self.clock() - self.last_ok_time).seconds / 60) > self.max_constant_error_time_minutes:
+            self.shutdown_kiln()
+        elif self.error < self.max_constant_error:
+            self.last_ok_time = self.clock()
+        if t0:
+            TRACER.end("monitor_check", t0, TRACE_ARGS, self.error, self.is_in_error_state())
+
     def _run(self):
         self.monitor_thread_running = True
+        self._loop_timer.reset()
         while self._monitor_thread_flag:
-            self.error = abs(self.kiln.setpoint_f - self.kiln.thermocouple_temp_f)
-
-            # Shutdown if max error exceeded
-            if self.error > self.max_error:
-                self.shutdown_kiln()
-            # If shutdown exceeds constant error for time limit
-            elif ((datetime.now() - self.last_ok_time).seconds / 60) > self.max_constant_error_time_minutes:
-                self.shutdown_kiln()
-            elif self.error < self.max_constant_error:
-                self.last_ok_time = datetime.now()
+            self._loop_timer.tick()
+            self.tick()
             time.sleep(1)
 
         self.monitor_thread_running = False
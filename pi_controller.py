@@ -1,10 +1,18 @@
 import time
 import threading
+from metrics import REGISTRY, PERIOD_BUCKETS
+from tracer import TRACER
+
+# Absolute control error buckets, in degrees F
+ERROR_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 300)
+
+# Args of the pi_compute trace span
+TRACE_ARGS = ("error", "p", "i", "throttle")
 
 
 class PIController:
 
-    def __init__(self, kiln, p, i, hz, print=False):
+    def __init__(self, kiln, p, i, hz, print=False, labels=None):
         self.kiln = kiln
         self.error = 0
         self._p = p
@@ -13,6 +21,22 @@ class PIController:
         self.i_value = 0
         self._hz = hz
 
+        # The PI thread waits on ready_event (ie. the scheduler's first setpoint) before its first tick,
+        # and sets first_tick_event once the first throttle command is out
+        self.ready_event = None
+        self.first_tick_event = threading.Event()
+
+        # Instrumentation
+        self._loop_timer = REGISTRY.loop_timer("kiln_pi_loop", 1.0 / hz, labels)
+        self._error_histogram = REGISTRY.histogram("kiln_pi_error_degrees_f", "Absolute PI control error",
+                                                   ERROR_BUCKETS, labels)
+        self._error_gauge = REGISTRY.gauge("kiln_pi_error_f", "Latest PI control error (setpoint - temp)", labels)
+        self._integrator_saturated = REGISTRY.counter("kiln_pi_integrator_saturated_total",
+                                                      "PI ticks with the integrator clamped at -100 or 100", labels)
+        self._stop_time = REGISTRY.histogram("kiln_thread_stop_seconds",
+                                             "Time taken for a stop_*_thread call to return", PERIOD_BUCKETS,
+                                             dict(labels or {}, thread="pi_controller_thread"))
+
         self.pi_thread = None
         self._pi_thread_flag = False
         self.pi_thread_running = False
@@ -30,29 +54,50 @@ class PIController:
 
     def _run(self):
         self.pi_thread_running = True
-        time.sleep(4)
+        if self.ready_event is not None:
+            while self._pi_thread_flag and not self.ready_event.wait(0.1):
+                pass
+        self._loop_timer.reset()
         while self._pi_thread_flag:
-            self.error = self.kiln.setpoint_f - self.kiln.thermocouple_temp_f
-            self.p_value = self.error * self._p
-            self.i_value += self.error * self._i
-            # Clamp integrator at -100 & 100 (no sense in winding up above max throttle)
-            if self.i_value < -100:
-                self.i_value = -100
-            if self.i_value > 100:
-                self.i_value = 100
-            throttle = self.p_value + self.i_value
-            throttle = int(round(throttle, 0))
-            self.kiln.set_throttle(throttle)
+            self._loop_timer.tick()
+            self.tick()
             time.sleep(1.0 / self._hz)
 
         self.kiln.set_throttle(0)
         self.pi_thread_running = False
 
+    def tick(self):
+        """
+        Runs one PI update and sets the kiln throttle. Called by the PI thread, or by the KilnManager control
+        executive when the kiln is managed.
+        """
+        t0 = TRACER.begin()
+        self.error = self.kiln.setpoint_f - self.kiln.thermocouple_temp_f
+        self._error_gauge.value = self.error
+        self._error_histogram.observe(abs(self.error))
+        self.p_value = self.error * self._p
+        self.i_value += self.error * self._i
+        # Clamp integrator at -100 & 100 (no sense in winding up above max throttle)
+        if self.i_value < -100:
+            self.i_value = -100
+            self._integrator_saturated.value += 1
+        if self.i_value > 100:
+            self.i_value = 100
+            self._integrator_saturated.value += 1
+        throttle = self.p_value + self.i_value
+        throttle = int(round(throttle, 0))
+        self.kiln.set_throttle(throttle)
+        self.first_tick_event.set()
+        if t0:
+            TRACER.end("pi_compute", t0, TRACE_ARGS, self.error, self.p_value, self.i_value, throttle)
+
     def stop_pi_thread(self):
+        start = time.monotonic()
         self._pi_thread_flag = False
         # wait for thread to shutdown
         while self.pi_thread_running:
             time.sleep(0.1)
+        self._stop_time.observe(time.monotonic() - start)
 
     def shutdown(self):
         self.stop_pi_thread()
@@ -0,0 +1,369 @@
+"""
+What-if planner for firing schedules. Simulates a schedule against the simulator.ThermalModel physics, with the
+same scheduler, PI controller and burst window behaviour as the kiln, for many variants at once with NumPy:
+rate and hold time tweaks, ambient temperatures, element derating and load (full power heating rate).
+
+    python planner.py schedules.json --program default --ambient 50 70 90 --derating 0.85 1.0 \\
+        --rate-scale 0.8 1.0 1.2 --element-watts 11500
+    python planner.py schedules.json --program default --derating 0.85 --fastest --max-rate 600
+
+For every variant it reports the predicted completion time, energy, max tracking error and the segments that
+can't be met. --fastest searches for the fastest ramp rates, within the rate limits, that every given condition
+can still track.
+
+Variants are stepped together one burst window at a time, so the PI integrator is updated once per window
+instead of once per second. Needs numpy (the kiln itself does not).
+"""
+import argparse
+import math
+import sys
+import numpy as np
+import simulator
+from scheduler import ScheduleHold, ScheduleCool
+from schedule_loader import load_library, build_schedule, ScheduleError, DEFAULT_MAX_RATE_F_PER_HOUR
+from throttle_interface import WINDOW_SECONDS
+
+RAMP, HOLD, COOL = 0, 1, 2
+
+# A ramp or cool taking longer than this multiple of its programmed time (plus settling grace) can't be met
+OVERRUN_FACTOR = 1.25
+OVERRUN_GRACE_HOURS = 0.1
+
+
+class PlanResult:
+    """
+    Simulation results. Per variant arrays have shape (variants,), per segment arrays (variants, segments).
+    Segments a variant never reached are NaN.
+    """
+
+    def __init__(self, variants, segments):
+        self.variants = variants
+        self.completion_hours = np.full(variants, np.nan)
+        self.energy_kwh = np.zeros(variants)
+        self.full_power_hours = np.zeros(variants)
+        self.max_error_f = np.zeros(variants)
+        self.segment_hours = np.full((variants, segments), np.nan)
+        self.segment_max_error_f = np.full((variants, segments), np.nan)
+        self.segment_energy_kwh = np.zeros((variants, segments))
+        self.infeasible = np.zeros((variants, segments), dtype=bool)
+        self.rates = None
+        self.hold_minutes = None
+
+    def is_feasible(self):
+        """
+        :return: Per variant bool - completed with every segment met
+        """
+        return ~np.isnan(self.completion_hours) & ~self.infeasible.any(axis=1)
+
+    def get_infeasible_segments(self, variant):
+        """
+        :return: 1 based step numbers of the segments this variant can't meet
+        """
+        return [int(step) + 1 for step in np.flatnonzero(self.infeasible[variant])]
+
+
+def _compile(schedule):
+    # Accept Scheduler steps or compiled definitions (ie. ["ramp", 100, 200])
+    kinds, rates, targets, minutes = [], [], [], []
+    for step in schedule:
+        if isinstance(step, (list, tuple)):
+            step = build_schedule([step])[0]
+        if isinstance(step, ScheduleHold):
+            kinds.append(HOLD)
+            rates.append(0.0)
+            targets.append(step.hold_temp_f)
+            minutes.append(step.hold_time_minutes)
+        else:
+            kinds.append(COOL if isinstance(step, ScheduleCool) else RAMP)
+            rates.append(step.rate_deg_f)
+            targets.append(step.target_f)
+            minutes.append(0.0)
+    return np.array(kinds), np.array(rates, dtype=float), np.array(targets, dtype=float), np.array(minutes,
+                                                                                                  dtype=float)
+
+
+def _per_segment(value, variants, segments):
+    # Scalar, (variants,) or (variants, segments) -> (variants, segments)
+    value = np.asarray(value, dtype=float)
+    if value.ndim == 1:
+        value = value[:, None]
+    return np.broadcast_to(value, (variants, segments))
+
+
+def variant_grid(**axes):
+    """
+    Builds every combination of the given axes, ie. variant_grid(ambient_f=[50, 90], derating=[0.9, 1.0]) gives
+    four variants
+    :return: Dict of axis name -> flat array, to pass on to simulate()
+    """
+    names = list(axes)
+    grids = np.meshgrid(*[np.atleast_1d(np.asarray(axes[name], dtype=float)) for name in names], indexing="ij")
+    return {name: grid.ravel() for name, grid in zip(names, grids)}
+
+
+def simulate(schedule, model=None, rate_scale=1.0, hold_scale=1.0, rates=None, ambient_f=None, derating=None,
+             full_power_rate_f_per_hour=None, element_watts=None, p=2, i=0.01, dt=WINDOW_SECONDS, max_hours=72,
+             tolerance_f=50, stop_after_step=None):
+    """
+    Simulates a firing for every variant at once. Every variant argument may be a scalar or a (variants,) array,
+    and the rate and hold arguments may also be (variants, segments) arrays to tweak single steps.
+    :param schedule: List of Scheduler steps or compiled step definitions
+    :param model: simulator.ThermalModel supplying the defaults for ambient, derating, load and equilibrium
+    :param rate_scale: Multiplier on the programmed ramp and cool rates
+    :param hold_scale: Multiplier on the programmed hold times
+    :param rates: Absolute ramp/cool rates, replacing the programmed ones (hold entries are ignored)
+    :param ambient_f: Room temperature
+    :param derating: Element output multiplier (worn elements, low supply voltage)
+    :param full_power_rate_f_per_hour: Heating rate at ambient with the elements fully on. Lower for a full load
+    :param element_watts: Element power, for energy. None reports full power hours only
+    :param p: PI controller proportional gain (per second, as in PIController)
+    :param i: PI controller integral gain (per second)
+    :param dt: Simulation step - one burst window
+    :param max_hours: Firing time limit. Variants still running are reported as not completing
+    :param tolerance_f: Tracking error a segment may reach before it counts as not met (the monitor's limit)
+    :param stop_after_step: Stop each variant once this 0 based step is done
+    :rtype: PlanResult
+    """
+    if model is None:
+        model = simulator.ThermalModel()
+    kinds, base_rates, targets, base_minutes = _compile(schedule)
+    segments = len(kinds)
+
+    ambient_f = np.atleast_1d(np.asarray(model.ambient_f if ambient_f is None else ambient_f, dtype=float))
+    derating = np.atleast_1d(np.asarray(model.derating if derating is None else derating, dtype=float))
+    full_power_rate = np.atleast_1d(np.asarray(model.full_power_rate_f_per_hour
+                                               if full_power_rate_f_per_hour is None
+                                               else full_power_rate_f_per_hour, dtype=float))
+    sizes = [len(ambient_f), len(derating), len(full_power_rate)] + \
+            [len(np.atleast_1d(value)) for value in (rate_scale, hold_scale, rates) if value is not None]
+    variants = max(sizes)
+    ambient_f, derating, full_power_rate = [np.broadcast_to(value, variants).copy()
+                                            for value in (ambient_f, derating, full_power_rate)]
+
+    rate = _per_segment(rates, variants, segments) if rates is not None else base_rates * _per_segment(
+        rate_scale, variants, segments)
+    rate = np.where(kinds == HOLD, 0.0, rate)
+    hold_seconds = base_minutes * 60 * _per_segment(hold_scale, variants, segments)
+    target = np.broadcast_to(targets, (variants, segments))
+    loss_span = model.equilibrium_f - ambient_f
+    element_kw = 0.0 if element_watts is None else element_watts / 1000
+    last_step = segments - 1 if stop_after_step is None else min(stop_after_step, segments - 1)
+
+    result = PlanResult(variants, segments)
+    result.rates = rate
+    result.hold_minutes = hold_seconds / 60
+
+    rows = np.arange(variants)
+    temp = ambient_f.copy()
+    index = np.zeros(variants, dtype=int)
+    step_start = np.zeros(variants)
+    start_temp = temp.copy()
+    setpoint = np.zeros(variants)
+    i_value = np.zeros(variants)
+    throttle = np.zeros(variants)
+    segment_start_temp = np.full((variants, segments), np.nan)
+    segment_start_temp[:, 0] = temp
+    # Hottest temperature the elements can hold - a ramp above it never completes, so it isn't simulated out
+    max_temp = ambient_f + derating * loss_span
+    stalled = (kinds[0] == RAMP) & (target[:, 0] >= max_temp)
+
+    steps = int(math.ceil(max_hours * 3600 / dt))
+    for n in range(steps):
+        now = n * dt
+        active = (index <= last_step) & ~stalled
+        if not active.any():
+            break
+
+        # Scheduler - complete the current step, then start the next in the same window
+        step = np.minimum(index, segments - 1)
+        kind = kinds[step]
+        step_target = target[rows, step]
+        elapsed = now - step_start
+        complete = active & (((kind == RAMP) & (temp >= step_target)) |
+                             ((kind == HOLD) & (elapsed > hold_seconds[rows, step])) |
+                             ((kind == COOL) & (temp <= step_target)))
+        if complete.any():
+            done_rows = rows[complete]
+            result.segment_hours[done_rows, step[complete]] = elapsed[complete] / 3600
+            index[complete] += 1
+            step_start[complete] = now
+            start_temp[complete] = temp[complete]
+            started = complete & (index < segments)
+            segment_start_temp[rows[started], index[started]] = temp[started]
+            finished = complete & (index > last_step)
+            result.completion_hours[finished] = now / 3600
+            step = np.minimum(index, segments - 1)
+            kind = kinds[step]
+            step_target = target[rows, step]
+            elapsed = now - step_start
+            stalled |= (index <= last_step) & (kind == RAMP) & (step_target >= max_temp)
+            active = (index <= last_step) & ~stalled
+
+        step_rate = rate[rows, step]
+        ramp_setpoint = np.minimum(start_temp + step_rate * elapsed / 3600, step_target)
+        cool_setpoint = np.maximum(start_temp - step_rate * elapsed / 3600, step_target)
+        cool_setpoint = np.where(throttle <= 0, np.maximum(cool_setpoint, np.minimum(temp, setpoint)), cool_setpoint)
+        setpoint = np.where(active, np.select([kind == RAMP, kind == HOLD], [ramp_setpoint, step_target],
+                                              cool_setpoint), setpoint)
+
+        # PI controller, with the integrator advanced for the whole window
+        error = setpoint - temp
+        i_value = np.clip(i_value + error * i * dt, -100, 100)
+        throttle = np.clip(np.round(error * p + i_value), 0, 100)
+        duty = np.where(active, throttle / 100, 0.0)
+
+        abs_error = np.where(active, np.abs(error), 0.0)
+        result.max_error_f = np.maximum(result.max_error_f, abs_error)
+        active_rows = rows[active]
+        active_steps = step[active]
+        result.segment_max_error_f[active_rows, active_steps] = np.fmax(
+            result.segment_max_error_f[active_rows, active_steps], abs_error[active])
+        window_full_power_hours = duty * derating * dt / 3600
+        result.full_power_hours += window_full_power_hours
+        result.segment_energy_kwh[active_rows, active_steps] += window_full_power_hours[active] * element_kw
+
+        # Thermal model (simulator.ThermalModel), one Euler step per window
+        temp = temp + full_power_rate / 3600 * (duty * derating - (temp - ambient_f) / loss_span) * dt
+
+    result.energy_kwh = result.full_power_hours * element_kw
+
+    # Segments that can't be met: tracked too far behind, took too long, or never finished
+    programmed_hours = np.abs(target - segment_start_temp) / np.where(rate > 0, rate, np.inf)
+    overrun = (kinds != HOLD) & (result.segment_hours > programmed_hours * OVERRUN_FACTOR + OVERRUN_GRACE_HOURS)
+    unfinished = (np.arange(segments) == np.minimum(index, segments - 1)[:, None]) & (index <= last_step)[:, None]
+    result.infeasible = (result.segment_max_error_f > tolerance_f) | overrun | unfinished
+    result.infeasible[:, last_step + 1:] = False
+    return result
+
+
+def find_fastest(schedule, max_rate=DEFAULT_MAX_RATE_F_PER_HOUR, min_rate=None, candidates=32, model=None,
+                 element_watts=None, tolerance_f=50, **conditions):
+    """
+    Searches for the fastest ramp rates that can still be met under every given condition, one ramp at a time in
+    schedule order (a ramp's start temperature depends on the ramps before it). Holds and cools are kept as
+    programmed - cooling can never be faster than the kiln loses heat, and holds are part of the recipe. A ramp no
+    candidate rate can meet everywhere keeps its programmed rate, and shows as infeasible in the returned result.
+    :param schedule: List of Scheduler steps or compiled step definitions
+    :param max_rate: Highest ramp rate allowed, F per hour
+    :param min_rate: Lowest ramp rate allowed. Defaults to the slowest programmed ramp or 50F per hour
+    :param candidates: Rates tried per ramp
+    :param conditions: Variant arguments of simulate() that must all be met, ie. ambient_f=[50, 90]
+    :return: (compiled definitions of the fastest schedule, PlanResult of it under each condition)
+    """
+    kinds, rates, targets, minutes = _compile(schedule)
+    if min_rate is None:
+        min_rate = min([rate for rate, kind in zip(rates, kinds) if kind == RAMP] + [50])
+    names = list(conditions)
+    values = np.broadcast_arrays(*[np.atleast_1d(np.asarray(conditions[name], dtype=float)) for name in names])
+    condition_count = len(values[0]) if values else 1
+    # Every candidate rate is tried under every condition: row = candidate * condition_count + condition
+    trial_conditions = {name: np.tile(value, candidates) for name, value in zip(names, values)}
+    candidate_rates = np.linspace(max_rate, min_rate, candidates)
+
+    chosen = np.where(kinds == RAMP, np.clip(rates, min_rate, max_rate), rates)
+    for step in np.flatnonzero(kinds == RAMP):
+        trial = np.tile(chosen, (candidates * condition_count, 1))
+        trial[:, step] = np.repeat(candidate_rates, condition_count)
+        result = simulate(schedule, model, rates=trial, element_watts=element_watts, tolerance_f=tolerance_f,
+                          stop_after_step=step, **trial_conditions)
+        met = ~result.infeasible.any(axis=1).reshape(candidates, condition_count)
+        met_everywhere = met.all(axis=1)
+        # Fastest candidate every condition meets. If none do, slowing down won't help - keep the programmed rate
+        chosen[step] = candidate_rates[np.argmax(met_everywhere)] if met_everywhere.any() else rates[step]
+
+    definitions = []
+    for kind, rate, target, hold in zip(kinds, chosen, targets, minutes):
+        if kind == HOLD:
+            definitions.append(["hold", _number(target), _number(hold)])
+        else:
+            definitions.append(["ramp" if kind == RAMP else "cool", _number(rate), _number(target)])
+    return definitions, simulate(definitions, model, element_watts=element_watts, tolerance_f=tolerance_f,
+                                 **dict(zip(names, values)))
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else round(value, 1)
+
+
+def format_table(result, variants):
+    """
+    :param variants: Dict of axis name -> per variant values, as from variant_grid()
+    :return: Text table with one row per variant
+    """
+    names = list(variants)
+    header = "".join("{:>12}".format(name[:11]) for name in names)
+    text = header + "{:>10} {:>9} {:>10} {:>9}  {}\n".format("Hours", "kWh", "FullPwr h", "Max err", "Not met")
+    for variant in range(result.variants):
+        hours = result.completion_hours[variant]
+        text += "".join("{:>12}".format(round(float(np.atleast_1d(variants[name])[variant]), 3)) for name in names)
+        text += "{:>10} {:>9} {:>10} {:>9}  {}\n".format(
+            "-" if np.isnan(hours) else round(hours, 2), round(result.energy_kwh[variant], 1),
+            round(result.full_power_hours[variant], 2), round(result.max_error_f[variant], 1),
+            ",".join(str(step) for step in result.get_infeasible_segments(variant)) or "-")
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate schedule variants against the kiln thermal model")
+    parser.add_argument("schedule", help="Schedule file (.json or .toml)")
+    parser.add_argument("--program", default="default", help="Program name in the schedule file")
+    parser.add_argument("--rate-scale", type=float, nargs="+", default=[1.0], help="Ramp/cool rate multipliers")
+    parser.add_argument("--hold-scale", type=float, nargs="+", default=[1.0], help="Hold time multipliers")
+    parser.add_argument("--ambient", type=float, nargs="+", default=[70], help="Ambient temperatures, F")
+    parser.add_argument("--derating", type=float, nargs="+", default=[1.0], help="Element output multipliers")
+    parser.add_argument("--full-power-rate", type=float, nargs="+", default=[1000],
+                        help="Heating rate at ambient with the elements fully on, F per hour (lower when loaded)")
+    parser.add_argument("--equilibrium", type=float, default=2400,
+                        help="Temperature a fully powered kiln levels out at")
+    parser.add_argument("--element-watts", type=float, help="Element power, for energy")
+    parser.add_argument("--tolerance", type=float, default=50, help="Tracking error a segment may reach, F")
+    parser.add_argument("--fastest", action="store_true",
+                        help="Search for the fastest ramp rates every condition can meet")
+    parser.add_argument("--max-rate", type=float, help="Fastest ramp rate allowed (default: the file's limit)")
+    parser.add_argument("--min-rate", type=float, help="Slowest ramp rate allowed")
+    args = parser.parse_args()
+
+    try:
+        library = load_library(args.schedule, cache_dir=None)
+    except ScheduleError as e:
+        print("Invalid schedule file:\n" + str(e))
+        sys.exit(1)
+    if args.program not in library["programs"]:
+        print("No program named '" + args.program + "'. Available: " + ", ".join(sorted(library["programs"])))
+        sys.exit(1)
+    schedule = library["programs"][args.program]
+    model = simulator.ThermalModel(equilibrium_f=args.equilibrium)
+
+    if args.fastest:
+        conditions = variant_grid(ambient_f=args.ambient, derating=args.derating,
+                                  full_power_rate_f_per_hour=args.full_power_rate)
+        max_rate = args.max_rate or library["limits"]["max_rate_f_per_hour"]
+        definitions, result = find_fastest(schedule, max_rate, args.min_rate, model=model,
+                                           element_watts=args.element_watts, tolerance_f=args.tolerance,
+                                           **conditions)
+        unreachable = result.infeasible.any(axis=0)
+        print("Fastest schedule within " + str(_number(max_rate)) + "F per hour:")
+        for number, (original, fastest) in enumerate(zip(schedule, definitions), 1):
+            print("    " + str(number) + ": " + " ".join(str(v) for v in fastest) +
+                  ("" if list(original) == fastest else "    (was " + " ".join(str(v) for v in original) + ")") +
+                  ("    (can't be met under every condition)" if unreachable[number - 1] else ""))
+        print()
+        print(format_table(result, conditions))
+        return
+
+    variants = variant_grid(rate_scale=args.rate_scale, hold_scale=args.hold_scale, ambient_f=args.ambient,
+                            derating=args.derating, full_power_rate_f_per_hour=args.full_power_rate)
+    result = simulate(schedule, model, element_watts=args.element_watts, tolerance_f=args.tolerance, **variants)
+    print(format_table(result, variants))
+    feasible = result.is_feasible()
+    print(str(int(feasible.sum())) + " of " + str(result.variants) + " variants complete with every segment met")
+    if feasible.any():
+        fastest = int(np.nanargmin(np.where(feasible, result.completion_hours, np.nan)))
+        print("Fastest: " + ", ".join(name + "=" + str(round(float(values[fastest]), 3))
+                                      for name, values in variants.items()) +
+              " - " + str(round(result.completion_hours[fastest], 2)) + " hours")
+
+
+if __name__ == "__main__":
+    main()
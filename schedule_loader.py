@@ -0,0 +1,247 @@
+"""
+Loads named firing programs from a JSON or TOML schedule file.
+
+File format (JSON shown, TOML uses the same keys with [[programs.<name>]] tables):
+
+    {
+        "limits": {"max_temp_f": 2400, "max_rate_f_per_hour": 1500},
+        "programs": {
+            "bisque_04": [
+                {"type": "ramp", "rate": 100, "target": 200},
+                {"type": "hold", "temp": 200, "minutes": 120},
+                {"type": "ramp", "rate": 400, "target": 1945},
+                {"type": "cool", "rate": 150, "target": 1000}
+            ]
+        }
+    }
+
+Step types:
+ramp - heat at 'rate' F per hour until 'target' F
+hold - hold at 'temp' F for 'minutes'
+cool - cool no faster than 'rate' F per hour until 'target' F
+
+Programs are validated and compiled to the same definition lists the Scheduler checkpoints
+(ie. ["ramp", 100, 200]). Compiled libraries are cached on disk keyed by a hash of the file content, so a
+large unchanged library is never reparsed or revalidated.
+"""
+import hashlib
+import json
+import math
+import os
+import sys
+from scheduler import ScheduleRamp, ScheduleHold, ScheduleCool
+
+# Bump when validation or the compiled format changes, to invalidate old cache entries
+COMPILER_VERSION = 3
+
+DEFAULT_MAX_TEMP_F = 2400
+DEFAULT_MAX_RATE_F_PER_HOUR = 1500
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".schedule_cache")
+
+# Compiled libraries already loaded by this process, keyed by content hash
+_memory_cache = {}
+
+# Step type -> (required fields, class)
+STEP_TYPES = {
+    "ramp": (("rate", "target"), ScheduleRamp),
+    "hold": (("temp", "minutes"), ScheduleHold),
+    "cool": (("rate", "target"), ScheduleCool),
+}
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+def _parse(data, path):
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ScheduleError("TOML schedule files need Python 3.11+ or the 'tomli' package")
+        try:
+            return tomllib.loads(data.decode())
+        except tomllib.TOMLDecodeError as e:
+            raise ScheduleError(path + ": " + str(e))
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        raise ScheduleError(path + ": " + str(e))
+
+
+def _is_finite_number(value):
+    # NaN and infinity get through json.loads (and every <, > comparison against them is False)
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def compile_program(name, steps, max_temp_f=DEFAULT_MAX_TEMP_F, max_rate=DEFAULT_MAX_RATE_F_PER_HOUR):
+    """
+    Validates a program and compiles it to a list of step definitions
+    :param name: Program name, used in messages
+    :param steps: List of step dicts
+    :return: (compiled definitions, list of warning strings)
+    :raises ScheduleError: If the program is invalid. The message lists every problem found
+    """
+    errors = []
+    warnings = []
+    compiled = []
+    if not isinstance(steps, list) or not steps:
+        raise ScheduleError(name + ": Program must be a non-empty list of steps")
+
+    last_temp = None
+    for number, step in enumerate(steps, 1):
+        where = name + " step " + str(number)
+        if not isinstance(step, dict) or step.get("type") not in STEP_TYPES:
+            errors.append(where + ": 'type' must be one of " + ", ".join(STEP_TYPES))
+            continue
+        step_type = step["type"]
+        fields, _ = STEP_TYPES[step_type]
+        values = [step.get(field) for field in fields]
+        invalid = [field for field, value in zip(fields, values) if not _is_finite_number(value)]
+        if invalid:
+            for field in invalid:
+                errors.append(where + ": '" + field + "' must be a finite number")
+            continue
+
+        if step_type == "hold":
+            temp, minutes = values
+            if minutes <= 0:
+                errors.append(where + ": Hold time must be greater than 0 minutes")
+        else:
+            rate, temp = values
+            if rate <= 0 or rate > max_rate:
+                errors.append(where + ": Rate must be between 0 and " + str(max_rate) + "F per hour")
+        if temp < 0 or temp > max_temp_f:
+            errors.append(where + ": Temperature must be between 0 and " + str(max_temp_f) + "F")
+
+        # Monotonicity - steps that will complete immediately or jump the setpoint
+        if last_temp is not None:
+            if step_type == "ramp" and temp <= last_temp:
+                warnings.append(where + ": Ramp target " + str(temp) + "F is not above the previous " +
+                                str(last_temp) + "F and will complete immediately (use a 'cool' step)")
+            if step_type == "cool" and temp >= last_temp:
+                warnings.append(where + ": Cool target " + str(temp) + "F is not below the previous " +
+                                str(last_temp) + "F and will complete immediately")
+            if step_type == "hold" and temp != last_temp:
+                warnings.append(where + ": Hold at " + str(temp) + "F steps the setpoint from " +
+                                str(last_temp) + "F")
+        last_temp = temp
+        compiled.append([step_type] + values)
+
+    if errors:
+        raise ScheduleError("\n".join(errors))
+    return compiled, warnings
+
+
+def compile_library(document, path="schedule"):
+    """
+    Validates and compiles every program in a parsed schedule document
+    :return: {"programs": {name: compiled}, "warnings": {name: [warning, ...]}, "limits": {...}}
+    """
+    if not isinstance(document, dict) or not isinstance(document.get("programs"), dict):
+        raise ScheduleError(path + ": Missing 'programs' table")
+    limits = document.get("limits", {})
+    if not isinstance(limits, dict):
+        raise ScheduleError(path + ": 'limits' must be a table")
+    max_temp_f = limits.get("max_temp_f", DEFAULT_MAX_TEMP_F)
+    max_rate = limits.get("max_rate_f_per_hour", DEFAULT_MAX_RATE_F_PER_HOUR)
+    errors = [path + ": Limit '" + key + "' must be a number greater than 0"
+              for key, value in (("max_temp_f", max_temp_f), ("max_rate_f_per_hour", max_rate))
+              if not _is_finite_number(value) or value <= 0]
+    if errors:
+        raise ScheduleError("\n".join(errors))
+
+    library = {"programs": {}, "warnings": {},
+               "limits": {"max_temp_f": max_temp_f, "max_rate_f_per_hour": max_rate}}
+    for name, steps in document["programs"].items():
+        try:
+            library["programs"][name], library["warnings"][name] = compile_program(name, steps, max_temp_f,
+                                                                                   max_rate)
+        except ScheduleError as e:
+            errors.append(str(e))
+    if errors:
+        raise ScheduleError("\n".join(errors))
+    return library
+
+
+def load_library(path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Loads and compiles every program in a schedule file, using the compiled cache when the content is unchanged
+    :param path: Path to a .json or .toml schedule file
+    :param cache_dir: Directory for compiled libraries. None disables the disk cache
+    :return: {"programs": {name: compiled}, "warnings": {name: [warning, ...]}, "limits": {...}}
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    key = hashlib.sha256(data + b"\0" + str(COMPILER_VERSION).encode()).hexdigest()
+
+    library = _memory_cache.get(key)
+    if library is not None:
+        return library
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, key + ".json")
+        try:
+            with open(cache_path) as file:
+                library = json.load(file)
+            _memory_cache[key] = library
+            return library
+        except (OSError, ValueError):
+            pass
+
+    library = compile_library(_parse(data, path), path)
+    _memory_cache[key] = library
+
+    if cache_path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(library, file)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print("ScheduleLoader: Could not write schedule cache - " + str(e))
+    return library
+
+
+def build_schedule(compiled):
+    """
+    Creates Scheduler step objects from compiled step definitions
+    """
+    return [STEP_TYPES[definition[0]][1](*definition[1:]) for definition in compiled]
+
+
+def load_schedule(path, program, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Loads a single named program from a schedule file as a list of Scheduler steps
+    :raises ScheduleError: If the file is invalid or the program does not exist
+    """
+    library = load_library(path, cache_dir)
+    if program not in library["programs"]:
+        raise ScheduleError(path + ": No program named '" + str(program) + "'. Available: " +
+                            ", ".join(sorted(library["programs"])))
+    for warning in library["warnings"].get(program, []):
+        print("ScheduleLoader: Warning - " + warning)
+    return build_schedule(library["programs"][program])
+
+
+if __name__ == "__main__":
+    # Validate a schedule file and list its programs: python schedule_loader.py schedules.json
+    if len(sys.argv) != 2:
+        print("Usage: python schedule_loader.py <schedule file>")
+        sys.exit(2)
+    try:
+        lib = load_library(sys.argv[1], cache_dir=None)
+    except ScheduleError as err:
+        print("Invalid schedule file:\n" + str(err))
+        sys.exit(1)
+    for program_name, definitions in lib["programs"].items():
+        print(program_name + ": " + str(len(definitions)) + " steps")
+        for step_definition in definitions:
+            print("    " + " ".join(str(v) for v in step_definition))
+        for program_warning in lib["warnings"][program_name]:
+            print("    Warning - " + program_warning)
@@ -1,8 +1,22 @@
 import threading
 import time
 import math
-from datetime import datetime
+import json
+import os
+from datetime import datetime, timedelta
 from enum import Enum
+from metrics import REGISTRY, PERIOD_BUCKETS
+from tracer import TRACER
+
+# Args of the scheduler_setpoint trace span
+TRACE_ARGS = ("setpoint_f", "step")
+
+# A resumed hold further than this from the kiln's temperature is reached by a recovery ramp, rather than stepping
+# the setpoint (and the monitor's error) by the whole difference
+RESUME_MAX_SETPOINT_STEP_F = 50
+
+# Recovery ramp rate used when the schedule has no ramp in that direction before the hold
+DEFAULT_RECOVERY_RATE_F = 300
 
 
 class ScheduleRamp:
@@ -19,6 +33,28 @@ class ScheduleRamp:
         text += "RAMP End Temp: " + str(round(self.target_f, 1)) + "F\n"
         return text
 
+    def get_definition(self):
+        return ["ramp", self.rate_deg_f, self.target_f]
+
+
+class ScheduleCool:
+    # Controlled cooling ramp. The elements can only add heat, so this limits how fast the kiln cools
+
+    def __init__(self, rate_deg_f, target_f):
+        self.start_time = datetime.now()
+        self.start_temp = 0
+        self.rate_deg_f = rate_deg_f
+        self.target_f = target_f
+
+    def get_stats(self):
+        text = "COOL Step\n"
+        text += "COOL at: " + str(self.rate_deg_f) + "F per hour\n"
+        text += "COOL End Temp: " + str(round(self.target_f, 1)) + "F\n"
+        return text
+
+    def get_definition(self):
+        return ["cool", self.rate_deg_f, self.target_f]
+
 
 class ScheduleHold:
 
@@ -34,28 +70,70 @@ class ScheduleHold:
         text += "Remaining Minutes: " + str(math.ceil(self.remaining_minutes)) + "\n"
         return text
 
+    def get_definition(self):
+        return ["hold", self.hold_temp_f, self.hold_time_minutes]
+
 
 class Scheduler:
 
-    def __init__(self, kiln):
+    def __init__(self, kiln, checkpoint_path=None, checkpoint_interval=30, labels=None):
+        """
+        :param kiln: Kiln being controlled
+        :param checkpoint_path: File the scheduler state is saved to for resuming after a crash. None disables
+        :param checkpoint_interval: Seconds between checkpoint writes
+        :param labels: Metric labels identifying this kiln
+        """
         self.kiln = kiln
         self.schedule = list()
         self._schedule_index = 0
         self._setpoint_f = 0
 
+        # Source of the current time for step timing. A replay benchmark swaps in the recording's clock
+        self.clock = datetime.now
+
+        # Checkpointing
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self._last_checkpoint_time = 0
+
+        # Index of the step that has been started (had its start time/temp set)
+        self._active_index = -1
+
+        # Ramp (or cool) back to a resumed hold's temperature, run before the hold continues
+        self._recovery_step = None
+
         self.schedule_thread = None
         self._schedule_thread_flag = False
         self.schedule_thread_running = False
 
+        # The scheduler thread waits on ready_event (ie. the first thermocouple sample) before its first tick,
+        # and sets first_tick_event once the first setpoint is out
+        self.ready_event = None
+        self.first_tick_event = threading.Event()
+
+        # Instrumentation
+        self._loop_timer = REGISTRY.loop_timer("kiln_scheduler_loop", 1, labels)
+        self._step_count = REGISTRY.counter("kiln_schedule_steps_completed_total", "Completed schedule steps",
+                                            labels)
+        self._stop_time = REGISTRY.histogram("kiln_thread_stop_seconds",
+                                             "Time taken for a stop_*_thread call to return", PERIOD_BUCKETS,
+                                             dict(labels or {}, thread="scheduler_thread"))
+
     def get_schedule_stats(self):
         text = "Currently on Schedule Step: " + str(self._schedule_index + 1) + " of " + str(len(self.schedule)) + "\n"
         if self._schedule_index < len(self.schedule):
             text += self.schedule[self._schedule_index].get_stats()
         return text
 
+    def get_schedule_index(self):
+        return self._schedule_index
+
     def set_setpoint(self, setpoint_f):
+        t0 = TRACER.begin()
         self._setpoint_f = setpoint_f
         self.kiln.setpoint_f = setpoint_f
+        if t0:
+            TRACER.end("scheduler_setpoint", t0, TRACE_ARGS, setpoint_f, self._schedule_index)
 
     def get_setpoint(self):
         return self._setpoint_f
@@ -73,73 +151,266 @@ class Scheduler:
 
     def _run(self):
         self.schedule_thread_running = True
-        time.sleep(2)
+        if self.ready_event is not None:
+            while self._schedule_thread_flag and not self.ready_event.wait(0.1):
+                pass
+        self._loop_timer.reset()
         while self._schedule_thread_flag:
-
-            # If schedule is complete
-            if self._schedule_index >= len(self.schedule):
-                # print("Scheduler: Schedule Complete!")
-                self.set_setpoint(0)
-                self._schedule_thread_flag = False
-                self.schedule_thread_running = False
-                self.kiln.shutdown()
+            self._loop_timer.tick()
+            if not self.tick():
                 return
+            time.sleep(1)
 
-            step = self.schedule[self._schedule_index]
+        self.schedule_thread_running = False
 
-            # Dispatch to appropriate step type function
-            if isinstance(step, ScheduleRamp):
-                self._ramp_loop(step)
+    def tick(self):
+        """
+        Advances the schedule once. Called every second by the scheduler thread, or by the KilnManager control
+        executive when the kiln is managed.
+        :return: False once the schedule is complete and the kiln has been shut down
+        """
+        # If schedule is complete
+        if self._schedule_index >= len(self.schedule):
+            # print("Scheduler: Schedule Complete!")
+            self.set_setpoint(0)
+            self._schedule_thread_flag = False
+            self.schedule_thread_running = False
+            self.remove_checkpoint()
+            self.kiln.shutdown()
+            return False
+
+        step = self.schedule[self._schedule_index]
+
+        if self._recovery_step is not None:
+            self._recovery_tick(step)
+            self.first_tick_event.set()
+            self._checkpoint_if_due()
+            return True
+
+        # Start the step on its first tick (a resumed step was already rebased from the checkpoint)
+        if self._active_index != self._schedule_index:
+            self._active_index = self._schedule_index
+            step.start_time = self.clock()
             if isinstance(step, ScheduleHold):
-                self._hold_loop(step)
+                self.set_setpoint(step.hold_temp_f)
+            else:
+                step.start_temp = self.kiln.thermocouple_temp_f
 
-        self.schedule_thread_running = False
+        # Dispatch to appropriate step type function
+        complete = False
+        if isinstance(step, ScheduleRamp):
+            complete = self._ramp_tick(step)
+        if isinstance(step, ScheduleHold):
+            complete = self._hold_tick(step)
+        if isinstance(step, ScheduleCool):
+            complete = self._cool_tick(step)
 
-    def _hold_loop(self, hold: ScheduleHold):
-        self.set_setpoint(hold.hold_temp_f)
-        hold.start_time = datetime.now()
+        self.first_tick_event.set()
 
-        while self._schedule_thread_flag:
-            # Check the time to see if we are complete
-            delta_seconds = (datetime.now() - hold.start_time).seconds
-            delta_minutes = delta_seconds / 60
-            hold.remaining_minutes = hold.hold_time_minutes - delta_minutes
-            if delta_minutes > hold.hold_time_minutes:
-                # print("Scheduler: HOLD step complete!")
-                self._schedule_index += 1
-                return
-            time.sleep(1)
+        if complete:
+            # print("Scheduler: Step complete!")
+            self._schedule_index += 1
+            self._step_count.value += 1
+            self.write_checkpoint()
+        else:
+            self._checkpoint_if_due()
+        return True
 
-    def _ramp_loop(self, ramp: ScheduleRamp):
-        ramp.start_time = datetime.now()
-        ramp.start_temp = self.kiln.thermocouple_temp_f
+    def _recovery_tick(self, hold: ScheduleHold):
+        recovery = self._recovery_step
+        if isinstance(recovery, ScheduleRamp):
+            complete = self._ramp_tick(recovery)
+        else:
+            complete = self._cool_tick(recovery)
+        if complete:
+            # Back at the hold temperature - continue the hold with the time it had already completed
+            self._recovery_step = None
+            elapsed_minutes = hold.hold_time_minutes - hold.remaining_minutes
+            hold.start_time = self.clock() - timedelta(minutes=elapsed_minutes)
+            self.set_setpoint(hold.hold_temp_f)
 
-        while self._schedule_thread_flag:
-            # Check temp to see if we are complete
-            if self.kiln.thermocouple_temp_f >= ramp.target_f:
-                # print("Scheduler: RAMP step complete!")
-                self._schedule_index += 1
-                return
+    def _hold_tick(self, hold: ScheduleHold):
+        # Check the time to see if we are complete
+        delta_seconds = (self.clock() - hold.start_time).seconds
+        delta_minutes = delta_seconds / 60
+        hold.remaining_minutes = hold.hold_time_minutes - delta_minutes
+        return delta_minutes > hold.hold_time_minutes
+
+    def _ramp_tick(self, ramp: ScheduleRamp):
+        # Check temp to see if we are complete
+        if self.kiln.thermocouple_temp_f >= ramp.target_f:
+            return True
 
-            delta_seconds = (datetime.now() - ramp.start_time).seconds
-            delta_minutes = delta_seconds / 60
-            delta_hours = delta_minutes / 60
-            setpoint = ramp.start_temp + (ramp.rate_deg_f * delta_hours)
-            # Clamp if we are exceeding target or max
-            if setpoint > ramp.target_f:
-                setpoint = ramp.target_f
-            self.set_setpoint(setpoint)
+        delta_seconds = (self.clock() - ramp.start_time).seconds
+        delta_minutes = delta_seconds / 60
+        delta_hours = delta_minutes / 60
+        setpoint = ramp.start_temp + (ramp.rate_deg_f * delta_hours)
+        # Clamp if we are exceeding target or max
+        if setpoint > ramp.target_f:
+            setpoint = ramp.target_f
+        self.set_setpoint(setpoint)
+        return False
 
-            time.sleep(1)
+    def _cool_tick(self, cool: ScheduleCool):
+        # Check temp to see if we are complete
+        if self.kiln.thermocouple_temp_f <= cool.target_f:
+            return True
+
+        delta_seconds = (self.clock() - cool.start_time).seconds
+        delta_hours = delta_seconds / 3600
+        setpoint = cool.start_temp - (cool.rate_deg_f * delta_hours)
+        # Clamp if we are below target
+        if setpoint < cool.target_f:
+            setpoint = cool.target_f
+        # If the kiln is cooling slower than the program with the elements already off, follow it down instead of
+        # building up error. While the elements are on the programmed setpoint is kept, so the PI integrator
+        # unwinds rather than freezing at zero error and holding the kiln up.
+        # Never follow it upward, so the monitor still catches a kiln that heats while cooling
+        if self.kiln.throttle_percent <= 0:
+            setpoint = max(setpoint, min(self.kiln.thermocouple_temp_f, self._setpoint_f))
+        self.set_setpoint(setpoint)
+        return False
 
     def stop_schedule_thread(self):
+        start = time.monotonic()
         self._schedule_thread_flag = False
         # wait for thread to shutdown
         while self.schedule_thread_running:
             time.sleep(0.1)
+        self._stop_time.observe(time.monotonic() - start)
 
     def shutdown(self):
         self.stop_schedule_thread()
         self.set_setpoint(0)
 
+    def get_checkpoint(self):
+        """
+        :return: Dict of the state needed to resume the schedule
+        """
+        checkpoint = {
+            "version": 1,
+            "time": time.time(),
+            "schedule": [step.get_definition() for step in self.schedule],
+            "schedule_index": self._schedule_index,
+            "setpoint_f": self._setpoint_f,
+            "temp_f": self.kiln.thermocouple_temp_f,
+            "pi_i_value": self.kiln.pi_controller.i_value if hasattr(self.kiln, "pi_controller") else 0,
+        }
+        if getattr(self.kiln, "energy_meter", None) is not None:
+            checkpoint["energy"] = self.kiln.energy_meter.get_checkpoint()
+        # A step the index has just moved on to has not started yet, and its start time is when it was built
+        if self._schedule_index < len(self.schedule) and self._active_index == self._schedule_index:
+            step = self.schedule[self._schedule_index]
+            if isinstance(step, (ScheduleRamp, ScheduleCool)):
+                checkpoint["ramp_start_time"] = step.start_time.timestamp()
+                checkpoint["ramp_start_temp"] = step.start_temp
+            if isinstance(step, ScheduleHold):
+                if self._recovery_step is not None:
+                    checkpoint["hold_elapsed_seconds"] = (step.hold_time_minutes - step.remaining_minutes) * 60
+                else:
+                    checkpoint["hold_elapsed_seconds"] = (self.clock() - step.start_time).total_seconds()
+        return checkpoint
+
+    def write_checkpoint(self):
+        """
+        Atomically writes the checkpoint file (write to temp file, fsync, rename over the old checkpoint)
+        """
+        if self.checkpoint_path is None:
+            return
+        self._last_checkpoint_time = time.monotonic()
+        tmp_path = self.checkpoint_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(self.get_checkpoint(), file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.checkpoint_path)
+        except OSError as e:
+            print("Scheduler: Error writing checkpoint - " + str(e))
+
+    def _checkpoint_if_due(self):
+        if self.checkpoint_path is not None and \
+                time.monotonic() - self._last_checkpoint_time >= self.checkpoint_interval:
+            self.write_checkpoint()
+
+    def remove_checkpoint(self):
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def resume_from_checkpoint(self):
+        """
+        Restores the schedule position from the checkpoint file. Must be called before the scheduler thread starts,
+        with a valid thermocouple reading on the kiln.
+
+        Ramps already passed by the current temperature are skipped. The current ramp is rebased to start from the
+        current temperature now, and a hold continues with the time it had already completed. If the kiln has
+        drifted away from the hold temperature (ie. cooled during the outage) it is ramped back first.
+        :return: True if the firing was resumed, False if there is no usable checkpoint
+        """
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            print("Scheduler: No checkpoint to resume from")
+            return False
+        try:
+            with open(self.checkpoint_path) as file:
+                checkpoint = json.load(file)
+        except (OSError, ValueError) as e:
+            print("Scheduler: Error reading checkpoint - " + str(e))
+            return False
+        if checkpoint.get("schedule") != [step.get_definition() for step in self.schedule]:
+            print("Scheduler: Checkpoint is for a different schedule - not resuming")
+            return False
+
+        temp_f = self.kiln.thermocouple_temp_f
+        index = checkpoint["schedule_index"]
+
+        # Skip any ramps the kiln is already past, so completed segments are not re-heated
+        while index < len(self.schedule):
+            step = self.schedule[index]
+            if isinstance(step, ScheduleRamp) and temp_f >= step.target_f:
+                index += 1
+            elif isinstance(step, ScheduleCool) and temp_f <= step.target_f:
+                index += 1
+            else:
+                break
+        self._schedule_index = index
+
+        if index < len(self.schedule):
+            step = self.schedule[index]
+            if isinstance(step, (ScheduleRamp, ScheduleCool)):
+                step.start_time = self.clock()
+                step.start_temp = temp_f
+                self.set_setpoint(temp_f)
+            if isinstance(step, ScheduleHold):
+                elapsed = checkpoint.get("hold_elapsed_seconds", 0) if index == checkpoint["schedule_index"] else 0
+                step.start_time = self.clock() - timedelta(seconds=elapsed)
+                step.remaining_minutes = step.hold_time_minutes - elapsed / 60
+                if abs(step.hold_temp_f - temp_f) > RESUME_MAX_SETPOINT_STEP_F:
+                    self._recovery_step = self._build_recovery_step(index, temp_f)
+                    self.set_setpoint(temp_f)
+                else:
+                    self.set_setpoint(step.hold_temp_f)
+            self._active_index = index
+
+        if hasattr(self.kiln, "pi_controller"):
+            self.kiln.pi_controller.i_value = checkpoint.get("pi_i_value", 0)
+        if getattr(self.kiln, "energy_meter", None) is not None and "energy" in checkpoint:
+            self.kiln.energy_meter.restore_checkpoint(checkpoint["energy"])
+        return True
+
+    def _build_recovery_step(self, index, temp_f):
+        # Ramp (or cool) from temp_f to the hold at index, at the rate of the schedule's last step in that direction
+        hold = self.schedule[index]
+        step_type = ScheduleRamp if temp_f < hold.hold_temp_f else ScheduleCool
+        rate = DEFAULT_RECOVERY_RATE_F
+        for step in reversed(self.schedule[:index]):
+            if isinstance(step, step_type):
+                rate = step.rate_deg_f
+                break
+        recovery = step_type(rate, hold.hold_temp_f)
+        recovery.start_time = self.clock()
+        recovery.start_temp = temp_f
+        print("Scheduler: Resuming hold from " + str(round(temp_f)) + "F - " +
+              ("ramping" if step_type is ScheduleRamp else "cooling") + " back to " + str(hold.hold_temp_f) + "F first")
+        return recovery
+
 
@@ -0,0 +1,162 @@
+"""
+Simulated kiln hardware: a lumped thermal model, a MAX31856 that reports the model temperature over a fake SPI
+device, and a GPIO module whose relay pins switch the model's elements.
+Select it with Kiln(backend="simulated") or 'python kiln.py --backend simulated'.
+"""
+import threading
+import time
+
+
+class ThermalModel:
+    """
+    First order kiln model: the elements add heat, and heat is lost in proportion to the difference to ambient.
+
+        dT/dt = full_power_rate * (duty * derating - (T - ambient) / (equilibrium - ambient))
+
+    So at ambient a fully powered kiln heats at full_power_rate, and it can never get hotter than equilibrium_f.
+    """
+
+    def __init__(self, ambient_f=70, full_power_rate_f_per_hour=1000, equilibrium_f=2400, derating=1.0,
+                 time_scale=1.0):
+        """
+        :param ambient_f: Room temperature
+        :param full_power_rate_f_per_hour: Heating rate at ambient with the elements fully on
+        :param equilibrium_f: Temperature a fully powered kiln levels out at
+        :param derating: Element output multiplier (ie. 0.9 for worn elements or low supply voltage)
+        :param time_scale: Simulated seconds per real second. Speeds up the physics only
+        """
+        self.ambient_f = ambient_f
+        self.full_power_rate_f_per_hour = full_power_rate_f_per_hour
+        self.equilibrium_f = equilibrium_f
+        self.derating = derating
+        self.time_scale = time_scale
+
+        self.temp_f = ambient_f
+        # Relay pin -> (share of the element power, on). Pin None is the single relay of a one zone kiln
+        self.elements = {None: [1.0, False]}
+        self._last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def get_rate_f_per_second(self, temp_f, duty):
+        loss = (temp_f - self.ambient_f) / (self.equilibrium_f - self.ambient_f)
+        return self.full_power_rate_f_per_hour / 3600 * (duty * self.derating - loss)
+
+    def _update(self):
+        now = time.monotonic()
+        dt = (now - self._last_update) * self.time_scale
+        self._last_update = now
+        # Integrate in short steps so large time scales stay stable
+        duty = sum(share for share, on in self.elements.values() if on)
+        while dt > 0:
+            step = min(dt, 10.0)
+            self.temp_f += self.get_rate_f_per_second(self.temp_f, duty) * step
+            dt -= step
+
+    def get_temp_f(self):
+        with self._lock:
+            self._update()
+            return self.temp_f
+
+    def add_element(self, relay_pin, share):
+        """
+        Splits the element power between zones - share is the fraction of the full power switched by relay_pin
+        """
+        with self._lock:
+            self.elements.pop(None, None)
+            self.elements[relay_pin] = [share, False]
+
+    def set_relay(self, on, relay_pin=None):
+        with self._lock:
+            self._update()
+            self.elements[relay_pin if relay_pin in self.elements else next(iter(self.elements))][1] = on
+
+
+class SimulatedMax31856:
+    """
+    Stands in for a spidev.SpiDev connected to a MAX31856. Register writes are stored, and reads of the
+    temperature registers return the model temperatures encoded as the chip does (two's complement).
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.registers = [0] * 16
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.lsbfirst = False
+
+    def open(self, bus_number, device_id):
+        pass
+
+    def close(self):
+        pass
+
+    def _update_temperature_registers(self):
+        cold_junc_c = (self.model.ambient_f - 32) / 1.8
+        thermocouple_c = (self.model.get_temp_f() - 32) / 1.8
+
+        # Cold junction: 14 bit, 2^-6 resolution, left aligned in 0x0A-0x0B
+        raw = (int(round(cold_junc_c * 64)) << 2) & 0xFFFF
+        self.registers[0x0A] = raw >> 8
+        self.registers[0x0B] = raw & 0xFF
+
+        # Thermocouple: 19 bit, 2^-7 resolution, left aligned in 0x0C-0x0E
+        raw = (int(round(thermocouple_c * 128)) << 5) & 0xFFFFFF
+        self.registers[0x0C] = raw >> 16
+        self.registers[0x0D] = (raw >> 8) & 0xFF
+        self.registers[0x0E] = raw & 0xFF
+
+        # No faults
+        self.registers[0x0F] = 0
+
+    def xfer2(self, data):
+        address = data[0] & 0x7F
+        if data[0] & 0x80:
+            # Write
+            for offset, value in enumerate(data[1:]):
+                self.registers[(address + offset) % 16] = value
+            return [0] * len(data)
+
+        self._update_temperature_registers()
+        return [0] + [self.registers[(address + offset) % 16] for offset in range(len(data) - 1)]
+
+
+class SimulatedGPIO:
+    """
+    Stands in for the RPi.GPIO module. Output pins mapped to a model switch its elements.
+    """
+
+    BOARD = "BOARD"
+    BCM = "BCM"
+    OUT = "OUT"
+    IN = "IN"
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, pin_models=None):
+        """
+        :param pin_models: Dict of relay pin number -> ThermalModel switched by that pin
+        """
+        self.pin_models = pin_models if pin_models is not None else {}
+        self.pin_states = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, initial=0):
+        self.output(pin, initial)
+
+    def output(self, pin, value):
+        self.pin_states[pin] = value
+        model = self.pin_models.get(pin)
+        if model is not None:
+            model.set_relay(bool(value), pin)
+
+    def cleanup(self, pin=None):
+        pins = list(self.pin_states) if pin is None else [pin]
+        for cleanup_pin in pins:
+            if cleanup_pin in self.pin_states:
+                self.output(cleanup_pin, self.LOW)
+                del self.pin_states[cleanup_pin]
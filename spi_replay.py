@@ -0,0 +1,240 @@
+"""
+Records the MAX31856 SPI traffic of a real firing, and replays it through Max31856/MAXController, so decoding and
+controller bugs can be reproduced off the kiln and full firings can be used as regression and throughput
+benchmarks.
+
+Record during a firing (one file per chip select, '{bus}' and '{device}' are filled in):
+
+    python kiln.py --backend record --spi-file firing_{bus}_{device}.kspi
+
+Replay at the recorded speed, or as fast as possible:
+
+    python kiln.py --backend replay --spi-file firing_0_0.kspi
+    python kiln.py --backend replay --spi-file firing_0_0.kspi --replay-speed 0
+
+Benchmark decoding (driver) or the acquisition + control + safety stack (kiln), in samples per second:
+
+    python spi_replay.py firing_0_0.kspi --stack kiln
+
+File format: a 14 byte header (b"KSPI", version, reserved byte, recording start time as a double) then one record
+per xfer2 call - microseconds since the previous record (uint32), transfer length (uint8), the bytes sent and the
+bytes received. A single register read is 9 bytes, 54 bytes per temperature sample.
+"""
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+MAGIC = b"KSPI"
+VERSION = 1
+HEADER = struct.Struct("<4sBxd")
+RECORD = struct.Struct("<IB")
+
+# Seconds between flushes of the recording file, so a crash loses at most this much of the recording
+FLUSH_INTERVAL = 1.0
+
+
+class ReplayError(ValueError):
+    pass
+
+
+class ReplayFinished(EOFError):
+    pass
+
+
+class SpiRecorder:
+    """
+    Wraps an open spidev.SpiDev and records every xfer2 request and response
+    """
+
+    def __init__(self, spi, path):
+        self.spi = spi
+        self.path = path
+        self.record_count = 0
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION, time.time()))
+        self._last_time = time.monotonic()
+        self._last_flush = self._last_time
+
+    def xfer2(self, data):
+        response = self.spi.xfer2(data)
+        now = time.monotonic()
+        delta_us = min(int((now - self._last_time) * 1000000), 0xFFFFFFFF)
+        self._last_time = now
+        self._file.write(RECORD.pack(delta_us, len(data)) + bytes(data) + bytes(response))
+        self.record_count += 1
+        if now - self._last_flush >= FLUSH_INTERVAL:
+            self._last_flush = now
+            self._file.flush()
+        return response
+
+    def close(self):
+        self._file.close()
+        self.spi.close()
+
+
+def read_recording(path):
+    """
+    Reads a recording made by SpiRecorder. A recording cut short by a crash is read up to its last whole record
+    :return: (recording start time, list of (seconds since start, request bytes, response bytes))
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < HEADER.size:
+        raise ReplayError(path + ": Not an SPI recording")
+    magic, version, start_time = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ReplayError(path + ": Not an SPI recording (or an unsupported version)")
+
+    records = []
+    offset = HEADER.size
+    seconds = 0.0
+    while offset + RECORD.size <= len(data):
+        delta_us, length = RECORD.unpack_from(data, offset)
+        end = offset + RECORD.size + 2 * length
+        if end > len(data):
+            break
+        request = data[offset + RECORD.size:offset + RECORD.size + length]
+        seconds += delta_us / 1000000
+        records.append((seconds, request, data[offset + RECORD.size + length:end]))
+        offset = end
+    return start_time, records
+
+
+class ReplaySpi:
+    """
+    Stands in for a spidev.SpiDev and answers xfer2 calls with a recording. Every request must match the recorded
+    one, so a change in what the driver sends is caught instead of silently decoding the wrong registers.
+    """
+
+    def __init__(self, path, speed=1.0):
+        """
+        :param path: Recording made by SpiRecorder
+        :param speed: Replay speed relative to the recording (1.0 = recorded timing). None or 0 replays as fast
+        as possible
+        """
+        self.path = path
+        self.speed = speed
+        self.start_time, self.records = read_recording(path)
+        self.position = 0
+        self._replay_start = None
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.lsbfirst = False
+
+    def open(self, bus_number, device_id):
+        pass
+
+    def close(self):
+        pass
+
+    def is_finished(self):
+        return self.position >= len(self.records)
+
+    def get_recorded_time(self):
+        """
+        :return: Wall clock time (datetime) the last replayed transfer was recorded at, or the recording start
+        before the first transfer. Lets the control stack run on recorded time while replaying faster than it
+        """
+        seconds = self.records[self.position - 1][0] if self.position > 0 else 0.0
+        return datetime.fromtimestamp(self.start_time + seconds)
+
+    def xfer2(self, data):
+        if self.position >= len(self.records):
+            raise ReplayFinished(self.path + ": End of recording after " + str(len(self.records)) + " transfers")
+        seconds, request, response = self.records[self.position]
+        if bytes(data) != request:
+            raise ReplayError(self.path + ": Transfer " + str(self.position) + " sent " + bytes(data).hex() +
+                              ", the recording has " + request.hex())
+        self.position += 1
+
+        if self.speed:
+            # Hold the response back until its recorded time
+            now = time.monotonic()
+            if self._replay_start is None:
+                self._replay_start = now - seconds / self.speed
+            delay = self._replay_start + seconds / self.speed - now
+            if delay > 0:
+                time.sleep(delay)
+        return list(response)
+
+
+def benchmark(path, stack="driver"):
+    """
+    Replays a recording as fast as possible and measures throughput
+    :param stack: "driver" decodes with Max31856 only. "kiln" runs every sample through MAXController and the
+    kiln's scheduler, PI controller, monitor and relay switching, with the scheduler and monitor timed by the
+    recording's timestamps. The replay stops early if the kiln shuts down, as the rest would only time reads
+    :return: Dict of samples, transfers, seconds and samples_per_second. The kiln stack adds kiln_shutdown,
+    schedule_complete, temp_f and the monitor's last error_f
+    """
+    import hardware
+    backend = hardware.get_backend("replay", path=path, speed=None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if stack == "kiln":
+            from kiln import Kiln
+            kiln = Kiln(standalone=False, backend=backend, telemetry_port=None, checkpoint_file=None,
+                        log_file=os.path.join(directory, "kiln.csv"))
+            spi = kiln.max_controller.max31856.spi
+            read = kiln.max_controller.read_temperatures
+            kiln.scheduler.clock = spi.get_recorded_time
+            kiln.monitor.clock = spi.get_recorded_time
+            kiln.monitor.last_ok_time = spi.get_recorded_time()
+
+            def sample():
+                read()
+                if not kiln.is_shutdown and kiln.scheduler.tick():
+                    kiln.pi_controller.tick()
+                    kiln.monitor.tick()
+                    kiln.throttle_interface.tick()
+        else:
+            from max31856_driver.max31856 import Max31856
+            driver = Max31856(backend.open_spi(0, 0))
+            spi = driver.spi
+
+            def sample():
+                driver.read_cold_junction_temperature()
+                driver.read_thermocouple_temperature()
+                driver.read_faults()
+
+        samples = 0
+        start = time.perf_counter()
+        try:
+            while not spi.is_finished():
+                sample()
+                samples += 1
+                if stack == "kiln" and kiln.is_shutdown:
+                    break
+        except ReplayFinished:
+            pass
+        seconds = time.perf_counter() - start
+
+    result = {"samples": samples, "transfers": spi.position, "seconds": seconds,
+              "samples_per_second": samples / seconds if seconds > 0 else 0.0}
+    if stack == "kiln":
+        result["kiln_shutdown"] = kiln.is_shutdown
+        result["schedule_complete"] = kiln.scheduler.get_schedule_index() >= len(kiln.scheduler.schedule)
+        result["temp_f"] = kiln.thermocouple_temp_f
+        result["error_f"] = kiln.monitor.error
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark replay of a recorded MAX31856 SPI session")
+    parser.add_argument("recording", help="Recording made with the 'record' backend")
+    parser.add_argument("--stack", default="driver", choices=("driver", "kiln"),
+                        help="Decode only, or run the full acquisition, control and safety stack")
+    args = parser.parse_args()
+
+    result = benchmark(args.recording, args.stack)
+    print("Replayed " + str(result["samples"]) + " samples (" + str(result["transfers"]) + " transfers) in " +
+          str(round(result["seconds"], 3)) + "s")
+    print("Samples decoded per second: " + str(round(result["samples_per_second"])))
+    if result.get("kiln_shutdown") and not result["schedule_complete"]:
+        print("Kiln shut down at " + str(round(result["temp_f"], 1)) + "F (monitor error " +
+              str(round(result["error_f"], 1)) + "F) - the rest of the recording was not replayed")
+        sys.exit(1)
@@ -0,0 +1,74 @@
+"""
+Measures cold start time, from launching a fresh Python process to the first PI control tick, against the
+simulated hardware backend.
+
+    python startup_benchmark.py --runs 10
+
+Reported phases (median / min / max over the runs, in milliseconds from process launch):
+imported      - kiln.py and its dependencies imported
+constructed   - Kiln() returned and its threads started
+first_sample  - first valid thermocouple reading
+first_tick    - first PI control tick (throttle command sent)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ("imported", "constructed", "first_sample", "first_tick")
+
+
+def _child():
+    # Runs in the measured process: report wall clock times of each startup phase to the parent
+    times = {}
+    import kiln
+    times["imported"] = time.time()
+
+    with tempfile.TemporaryDirectory() as directory:
+        k = kiln.Kiln(backend="simulated", headless=True, telemetry_port=None, checkpoint_file=None,
+                      log_file=os.path.join(directory, "kiln.csv"))
+        times["constructed"] = time.time()
+        k.max_controller.first_sample_event.wait(30)
+        times["first_sample"] = time.time()
+        k.pi_controller.first_tick_event.wait(30)
+        times["first_tick"] = time.time()
+
+        k.shutdown()
+        k.monitor.stop_monitor_thread()
+        k.max_controller.stop_spi_thread()
+    print(json.dumps(times))
+
+
+def run_once():
+    start = time.time()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], check=True,
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    times = json.loads(output.strip().splitlines()[-1])
+    return {phase: (times[phase] - start) * 1000 for phase in PHASES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start to first control tick benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Number of process launches to measure")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child()
+        return
+
+    results = [run_once() for _ in range(args.runs)]
+    print("Startup benchmark - " + str(args.runs) + " runs, ms from process launch")
+    print("{:<14} {:>9} {:>9} {:>9}".format("Phase", "Median", "Min", "Max"))
+    for phase in PHASES:
+        values = [result[phase] for result in results]
+        print("{:<14} {:>9.1f} {:>9.1f} {:>9.1f}".format(phase, statistics.median(values), min(values),
+                                                          max(values)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import struct
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from metrics import REGISTRY
+from tracer import TRACER
+
+# Magic value from RFC 6455 used to compute the Sec-WebSocket-Accept handshake header
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Numeric fields kept in the history buffer. Stored as tuples to keep a full firing in memory on a Pi
+HISTORY_FIELDS = ("thermocouple_temp_f", "setpoint_f", "throttle_percent", "p_value", "i_value", "schedule_step",
+                  "energy_kwh")
+
+
+class TelemetryServer:
+    """
+    Embedded HTTP + WebSocket server exposing live kiln state as JSON.
+
+    Endpoints:
+    GET /state    - The most recent full state sample
+    GET /history  - Downsampled history. Query params: start, end (epoch seconds), points (max samples returned)
+    GET /stream   - WebSocket. Sends a full "key" frame, then "delta" frames holding only the changed fields
+    GET /metrics  - Runtime metrics in the Prometheus text format
+    GET /trace    - Chrome Trace Event JSON of the recorded control spans (empty unless tracing is enabled)
+
+    The server samples the state source from its own thread, so control loops never wait on clients. Every
+    client gets a bounded queue; when a slow client falls behind, its oldest samples are dropped.
+    """
+
+    def __init__(self, state_source, host="127.0.0.1", port=8080, sample_interval=1, history_interval=5,
+                 history_length=20000, client_queue_size=32, keyframe_interval=60, metrics_registry=REGISTRY,
+                 history_fields=HISTORY_FIELDS):
+        """
+        :param state_source: Callable returning a flat dict of the current state (ie. Kiln.get_state)
+        :param host: Interface to bind. Defaults to localhost only
+        :param port: TCP port to listen on
+        :param sample_interval: Seconds between state samples pushed to stream clients
+        :param history_interval: Seconds between samples stored in the history buffer
+        :param history_length: Max number of history samples kept (20000 @ 5s is ~27 hours)
+        :param client_queue_size: Max samples buffered per stream client before the oldest are dropped
+        :param keyframe_interval: Number of delta frames between full key frames on the stream
+        :param metrics_registry: MetricsRegistry served on /metrics
+        :param history_fields: Numeric state fields kept in the history buffer
+        """
+        self.state_source = state_source
+        self.host = host
+        self.port = port
+        self.sample_interval = sample_interval
+        self.history_interval = history_interval
+        self.client_queue_size = client_queue_size
+        self.keyframe_interval = keyframe_interval
+        self.metrics_registry = metrics_registry
+        self.history_fields = tuple(history_fields)
+
+        self.history = deque(maxlen=history_length)
+        self.latest_sample = None
+        self.clients = set()
+        self._connections = set()
+        self.dropped_samples = 0
+        self._last_history_time = 0
+
+        self.server_thread = None
+        self._server_thread_flag = False
+        self.server_thread_running = False
+        self._loop = None
+        self._stop_event = None
+
+    def start_server_thread(self):
+        if not self.server_thread_running:
+            self._server_thread_flag = True
+            self.server_thread = threading.Thread(group=None, target=self._run, name="telemetry_server_thread",
+                                                  daemon=True)
+            self.server_thread.start()
+            return True
+        else:
+            print("TelemetryServer: Tried to start server thread, but thread is already running!")
+            return False
+
+    def stop_server_thread(self):
+        self._server_thread_flag = False
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        # wait for thread to shutdown
+        while self.server_thread_running:
+            time.sleep(0.1)
+
+    def _run(self):
+        self.server_thread_running = True
+        try:
+            asyncio.run(self._serve())
+        except OSError as e:
+            print("TelemetryServer: Error - Could not start server on " + self.host + ":" + str(self.port) +
+                  " (" + str(e) + ")")
+        self.server_thread_running = False
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        sampler = asyncio.create_task(self._sample_loop())
+        try:
+            if self._server_thread_flag:
+                await self._stop_event.wait()
+        finally:
+            sampler.cancel()
+            server.close()
+            for queue in list(self.clients):
+                self._enqueue(queue, None)
+            await server.wait_closed()
+            # Finish open connections here, rather than leaving asyncio.run to cancel them
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            self._loop = None
+
+    # ---------------------------------------------------------------------------------------------------------
+    # Sampling
+    # ---------------------------------------------------------------------------------------------------------
+
+    def sample(self):
+        """
+        Takes a state sample, records it in the history and pushes it to every stream client
+        """
+        state = self.state_source()
+        self.latest_sample = state
+
+        now = state.get("time", time.time())
+        if now - self._last_history_time >= self.history_interval:
+            self._last_history_time = now
+            self.history.append((now,) + tuple(state.get(field, 0) for field in self.history_fields))
+
+        for queue in self.clients:
+            self._enqueue(queue, state)
+        return state
+
+    async def _sample_loop(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                # Never let a bad sample take the server down
+                print("TelemetryServer: Error sampling state - " + str(e))
+            await asyncio.sleep(self.sample_interval)
+
+    def _enqueue(self, queue, state):
+        # Drop the oldest sample rather than waiting on a slow client
+        if queue.full():
+            queue.get_nowait()
+            self.dropped_samples += 1
+        queue.put_nowait(state)
+
+    def get_history(self, start=None, end=None, points=500):
+        """
+        Returns history samples between start and end (epoch seconds), averaged into at most 'points' buckets
+        """
+        samples = list(self.history)
+        times = [s[0] for s in samples]
+        lo = 0 if start is None else bisect_left(times, start)
+        hi = len(samples) if end is None else bisect_right(times, end)
+        samples = samples[lo:hi]
+
+        points = max(1, int(points))
+        if len(samples) > points:
+            bucket_size = len(samples) / points
+            downsampled = []
+            for bucket in range(points):
+                chunk = samples[int(bucket * bucket_size):int((bucket + 1) * bucket_size)]
+                if chunk:
+                    downsampled.append(tuple(sum(col) / len(chunk) for col in zip(*chunk)))
+            samples = downsampled
+
+        return {"fields": ("time",) + self.history_fields,
+                "samples": [[round(v, 2) for v in s] for s in samples]}
+
+    # ---------------------------------------------------------------------------------------------------------
+    # HTTP
+    # ---------------------------------------------------------------------------------------------------------
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            lines = request.decode("latin-1").split("\r\n")
+            method, target, _ = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+
+            url = urlsplit(target)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+            if method != "GET":
+                await self._send_response(writer, 405, {"error": "Method not allowed"})
+            elif url.path == "/stream" and headers.get("upgrade", "").lower() == "websocket":
+                await self._handle_stream(reader, writer, headers)
+            elif url.path == "/state":
+                await self._send_response(writer, 200, self.latest_sample or self.sample())
+            elif url.path == "/metrics":
+                await self._send_response(writer, 200, self.metrics_registry.render(),
+                                          "text/plain; version=0.0.4")
+            elif url.path == "/trace":
+                await self._send_response(writer, 200, TRACER.get_trace())
+            elif url.path == "/history":
+                try:
+                    start = _to_float(query.get("start"), "start")
+                    end = _to_float(query.get("end"), "end")
+                    points = _to_float(query.get("points"), "points") or 500
+                except ValueError as e:
+                    await self._send_response(writer, 400, {"error": str(e)})
+                    return
+                await self._send_response(writer, 200, self.get_history(start, end, points))
+            else:
+                await self._send_response(writer, 404, {"error": "Not found"})
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError,
+                asyncio.CancelledError):
+            # Client gone, bad request, or the server is stopping
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _send_response(self, writer, status, body, content_type="application/json"):
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+        payload = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        head = "HTTP/1.1 " + str(status) + " " + reasons[status] + "\r\n"
+        head += "Content-Type: " + content_type + "\r\n"
+        head += "Content-Length: " + str(len(payload)) + "\r\n"
+        head += "Access-Control-Allow-Origin: *\r\n"
+        head += "Connection: close\r\n\r\n"
+        writer.write(head.encode() + payload)
+        await writer.drain()
+
+    # ---------------------------------------------------------------------------------------------------------
+    # WebSocket
+    # ---------------------------------------------------------------------------------------------------------
+
+    async def _handle_stream(self, reader, writer, headers):
+        key = headers.get("sec-websocket-key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        head = "HTTP/1.1 101 Switching Protocols\r\n"
+        head += "Upgrade: websocket\r\n"
+        head += "Connection: Upgrade\r\n"
+        head += "Sec-WebSocket-Accept: " + accept + "\r\n\r\n"
+        writer.write(head.encode())
+        await writer.drain()
+
+        queue = asyncio.Queue(maxsize=self.client_queue_size)
+        if self.latest_sample is not None:
+            queue.put_nowait(self.latest_sample)
+        self.clients.add(queue)
+        sender = asyncio.create_task(self._stream_sender(queue, writer))
+        try:
+            # Only control frames are expected from clients - anything else is ignored
+            while True:
+                opcode, payload = await _read_frame(reader)
+                if opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    writer.write(_encode_frame(0xA, payload))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Client gone, or the server is stopping
+            pass
+        finally:
+            self.clients.discard(queue)
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            if not writer.is_closing():
+                try:
+                    writer.write(_encode_frame(0x8, b""))
+                except ConnectionError:
+                    pass
+
+    async def _stream_sender(self, queue, writer):
+        # Deltas are computed against what this client was last sent, so dropped samples never corrupt its view
+        last_sent = None
+        seq = 0
+        try:
+            while True:
+                state = await queue.get()
+                if state is None:
+                    break
+                if last_sent is None or seq % self.keyframe_interval == 0:
+                    message = {"type": "key", "seq": seq, "data": state}
+                else:
+                    delta = {k: v for k, v in state.items() if last_sent.get(k) != v}
+                    message = {"type": "delta", "seq": seq, "data": delta}
+                last_sent = state
+                seq += 1
+                writer.write(_encode_frame(0x1, json.dumps(message).encode()))
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # Client dropped, or the stream handler finished
+            return
+        writer.close()
+
+
+def _encode_frame(opcode, payload):
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 65536:
+        header += bytes([126]) + struct.pack(">H", length)
+    else:
+        header += bytes([127]) + struct.pack(">Q", length)
+    return header + payload
+
+
+async def _read_frame(reader):
+    first, second = await reader.readexactly(2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack(">H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack(">Q", await reader.readexactly(8))[0]
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask is not None:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+
+def _to_float(value, name):
+    # Query parameter as a finite float. Raises ValueError, with a message for the client, if it isn't one
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        number = math.nan
+    if not math.isfinite(number):
+        raise ValueError("'" + name + "' must be a finite number")
+    return number
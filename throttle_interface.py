@@ -1,29 +1,87 @@
 import threading
 import time
+from collections import deque
 
-import RPi.GPIO as GPIO
+from metrics import REGISTRY, PERIOD_BUCKETS
+from tracer import TRACER
+
+# Length of a throttle burst window in seconds
+WINDOW_SECONDS = 10
+
+# Args of the relay_on/relay_off trace events
+TRACE_ARGS = ("pin", "throttle")
 
 
 class ThrottleInterface:
 
-    def __init__(self, relay_pin):
+    def __init__(self, relay_pin, labels=None, gpio=None):
+        """
+        :param relay_pin: Raspberry Pi header pin driving the element relay
+        :param labels: Metric labels identifying this kiln
+        :param gpio: GPIO module from the hardware backend. Defaults to RPi.GPIO
+        """
         self.relay_pin = relay_pin
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self.gpio = gpio
 
         # Setup Relay GPIO Output
-        GPIO.setmode(GPIO.BOARD)  # Set BOARD output to use Raspberry Pi header numeric pin numbers
-        GPIO.setup(relay_pin, GPIO.OUT, initial=GPIO.LOW)  # Output pin, default to off
+        gpio.setmode(gpio.BOARD)  # Set BOARD output to use Raspberry Pi header numeric pin numbers
+        gpio.setup(relay_pin, gpio.OUT, initial=gpio.LOW)  # Output pin, default to off
 
         # Throttle Variables
         self._throttle_command = 0
+        self._window_start = None
+        self._window_throttle = 0
 
         self.throttle_thread = None
         self._throttle_thread_flag = False
         self.throttle_thread_running = False
+        self._wake_event = threading.Event()  # Set to cut the current edge sleep short when stopping
+
+        # Measured relay on-time, for energy accounting. Differs from the command because of the burst window
+        self._relay_state = False
+        self._relay_on_since = None
+        self.relay_on_seconds = 0.0
+
+        # Instrumentation
+        pin_labels = dict(labels or {}, pin=relay_pin)
+        self._relay_switches = REGISTRY.counter("kiln_relay_switches_total", "Relay on/off transitions", pin_labels)
+        self._window_time = REGISTRY.histogram("kiln_throttle_window_seconds",
+                                               "Measured throttle window length (target " + str(WINDOW_SECONDS) + "s)",
+                                               PERIOD_BUCKETS, pin_labels)
+        self._stop_time = REGISTRY.histogram("kiln_thread_stop_seconds",
+                                             "Time taken for a stop_*_thread call to return", PERIOD_BUCKETS,
+                                             dict(labels or {}, thread="throttle_interface_thread"))
+
+    def _set_relay(self, on):
+        if on != self._relay_state:
+            now = time.monotonic()
+            if on:
+                self._relay_on_since = now
+            else:
+                self.relay_on_seconds += now - self._relay_on_since
+                self._relay_on_since = None
+            self._relay_state = on
+            self._relay_switches.value += 1
+            if TRACER.enabled:
+                TRACER.instant("relay_on" if on else "relay_off", TRACE_ARGS, self.relay_pin, self._throttle_command)
+        self.gpio.output(self.relay_pin, self.gpio.HIGH if on else self.gpio.LOW)
+
+    def get_relay_on_seconds(self):
+        """
+        :return: Total seconds the relay has been closed, including the current on period
+        """
+        on_since = self._relay_on_since
+        if on_since is None:
+            return self.relay_on_seconds
+        return self.relay_on_seconds + time.monotonic() - on_since
 
     def start_throttle_thread(self):
         if not self.throttle_thread_running:
             # print("Starting Throttle Thread...")
             self._throttle_thread_flag = True
+            self._wake_event.clear()
             self.throttle_thread = threading.Thread(group=None, target=self._run, name="throttle_interface_thread")
             self.throttle_thread.start()
             return True
@@ -33,36 +91,40 @@ class ThrottleInterface:
 
     def _run(self):
         self.throttle_thread_running = True
+        self._window_start = None
         while self._throttle_thread_flag:
-
-            # Grab the current throttle command - since it may change during runtime
-            throttle = self._throttle_command
-            # print("Throttle Command: " + str(throttle) + "%")
-
-            # Throttle control operates on a 10-second burst window. 100% = 10 seconds on; 50% = 5 sec on, 5 sec off
-
-            # Only turn on the element is throttle is greater than zero
-            if throttle > 0:
-                GPIO.output(self.relay_pin, GPIO.HIGH)
-                # print("Throttle On")
-            else:
-                GPIO.output(self.relay_pin, GPIO.LOW)
-
-            # Sleep for the on-time
-            time.sleep(0.1 * throttle)
-
-            # Only turn element off if throttle not full throttle (100%)
-            if throttle < 100:
-                GPIO.output(self.relay_pin, GPIO.LOW)
-                # print("Throttle Off")
-                # Sleep for the remainder of the time period
-                time.sleep(0.1 * (100 - throttle))
+            # Sleep until the next relay edge
+            self._wake_event.wait(self.tick())
 
         self.set_throttle(0)
-        GPIO.output(self.relay_pin, GPIO.LOW)
+        self._set_relay(False)
         # print("Throttle Off")
         self.throttle_thread_running = False
 
+    def tick(self):
+        """
+        Switches the relay for the current point in the burst window. Called by the throttle thread, or by the
+        KilnManager control executive when the kiln is managed.
+        :return: Seconds until the relay next needs to switch
+        """
+        now = time.monotonic()
+        if self._window_start is None or now - self._window_start >= WINDOW_SECONDS:
+            if self._window_start is not None:
+                self._window_time.observe(now - self._window_start)
+            self._window_start = now
+            # Grab the current throttle command - since it may change during runtime
+            self._window_throttle = self._throttle_command
+            # print("Throttle Command: " + str(self._window_throttle) + "%")
+
+        # Throttle control operates on a 10-second burst window. 100% = 10 seconds on; 50% = 5 sec on, 5 sec off
+        on_seconds = WINDOW_SECONDS / 100 * self._window_throttle
+        elapsed = now - self._window_start
+        if elapsed < on_seconds:
+            self._set_relay(True)
+            return on_seconds - elapsed
+        self._set_relay(False)
+        return WINDOW_SECONDS - elapsed
+
     def set_throttle(self, throttle_command):
         throttle = int(throttle_command)
         if throttle < 0 or throttle > 100:
@@ -75,17 +137,306 @@ class ThrottleInterface:
         return True
 
     def stop_throttle_thread(self):
+        start = time.monotonic()
         self._throttle_thread_flag = False
+        self._wake_event.set()
         # wait for thread to shutdown
         while self.throttle_thread_running:
             time.sleep(0.1)
+        self._stop_time.observe(time.monotonic() - start)
 
     def cleanup(self):
-        GPIO.cleanup()
+        # Only release this relay's pin - other kilns in the same process may still be driving theirs
+        self.gpio.cleanup(self.relay_pin)
 
     def shutdown(self):
         self.stop_throttle_thread()
-        GPIO.output(self.relay_pin, GPIO.LOW)
+        self._set_relay(False)
         self.cleanup()
 
 
+# Slots per burst window for multi-zone planning - one per throttle percent
+WINDOW_SLOTS = 100
+
+
+def _pack_window(wanted, loads, load_budget, slots):
+    # Greedy packing - see plan_window(). Returns (per zone slot states, granted slots per zone)
+    slot_load = [0.0] * slots
+    states = [[False] * slots for _ in wanted]
+    # Biggest energy first, so the hardest zones to fit get the pick of the phases
+    for zone in sorted(range(len(wanted)), key=lambda z: (-wanted[z] * loads[z], z)):
+        duty, load = wanted[zone], loads[zone]
+        if duty <= 0:
+            continue
+        # Lowest peak, then least overlap with the zones already placed. Circular sliding window max and sum
+        doubled = slot_load + slot_load
+        best_offset, best_key = 0, None
+        window = deque()
+        total = 0.0
+        for end in range(slots + duty - 1 if duty < slots else duty):
+            while window and doubled[window[-1]] <= doubled[end]:
+                window.pop()
+            window.append(end)
+            total += doubled[end]
+            offset = end - duty + 1
+            if offset < 0:
+                continue
+            if window[0] < offset:
+                window.popleft()
+            key = (doubled[window[0]], total)
+            if best_key is None or key < best_key:
+                best_offset, best_key = offset, key
+            total -= doubled[offset]
+
+        if load_budget is None or best_key[0] + load <= load_budget:
+            chosen = [(best_offset + k) % slots for k in range(duty)]
+        else:
+            free = [slot for slot in range(slots) if slot_load[slot] + load <= load_budget]
+            chosen = sorted(free, key=lambda slot: slot_load[slot])[:duty]
+        for slot in chosen:
+            states[zone][slot] = True
+            slot_load[slot] += load
+    return states, [sum(zone_states) for zone_states in states]
+
+
+def plan_window(duties, loads, load_budget=None, slots=WINDOW_SLOTS):
+    """
+    Places each zone's on-time in a burst window so the total load of the zones on at once stays within the
+    budget. Each zone gets one contiguous block where possible, at the phase that keeps the peak lowest, so zones
+    are staggered rather than all switching on at the window start. A zone that doesn't fit contiguously is given
+    the least loaded slots instead. If the duties can't all be packed under the budget, every zone is scaled down
+    by the same factor, to the largest that packs.
+    :param duties: Duty per zone, in slots
+    :param loads: Load per zone (amps or watts)
+    :param load_budget: Max total load on at once, same unit as loads. None only staggers
+    :return: (per zone list of per slot on states, granted duty per zone in slots)
+    """
+    wanted = [max(0, min(slots, int(duty))) for duty in duties]
+    states, granted = _pack_window(wanted, loads, load_budget, slots)
+    if load_budget is None or granted == wanted:
+        return states, granted
+
+    # Largest common scale factor that packs. The budget's energy limit bounds it from above
+    demand = sum(duty * load for duty, load in zip(wanted, loads))
+    high = min(1.0, load_budget * slots / demand)
+    scaled = [int(duty * high) for duty in wanted]
+    best = _pack_window(scaled, loads, load_budget, slots)
+    if best[1] == scaled:
+        return best
+    low = 0.0
+    best = _pack_window([0] * len(wanted), loads, load_budget, slots)
+    for _ in range(7):
+        scale = (low + high) / 2
+        scaled = [int(duty * scale) for duty in wanted]
+        states, granted = _pack_window(scaled, loads, load_budget, slots)
+        if granted == scaled:
+            low, best = scale, (states, granted)
+        else:
+            high = scale
+    return best
+
+
+class MultiZoneThrottle:
+    """
+    Drives several element zone relays, each with its own duty command, on the same 10 second burst window.
+    Within each window the zones' on-times are phased by plan_window() so the load of the zones on at once stays
+    under load_budget, while every zone still gets its commanded duty whenever the budget allows it.
+
+    Drop-in for ThrottleInterface: set_throttle() commands every zone, and get_relay_on_seconds() reports full
+    power equivalent seconds (on-time weighted by zone load), so energy accounting keeps using the total element
+    power.
+    """
+
+    def __init__(self, zones, load_budget=None, labels=None, gpio=None):
+        """
+        :param zones: List of zone dicts - {"relay_pin": header pin, "load": zone current or power (default 1)}
+        :param load_budget: Max total load of the zones on at once, in the unit of the zone loads. None only
+        staggers the zones
+        :param labels: Metric labels identifying this kiln
+        :param gpio: GPIO module from the hardware backend. Defaults to RPi.GPIO
+        """
+        self.relay_pins = [zone["relay_pin"] for zone in zones]
+        self.loads = [float(zone.get("load", 1)) for zone in zones]
+        self.load_budget = load_budget
+        if load_budget is not None and max(self.loads) > load_budget:
+            raise ValueError("MultiZoneThrottle: A zone load is above the load budget - it could never switch on")
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self.gpio = gpio
+
+        # Setup Relay GPIO Outputs
+        gpio.setmode(gpio.BOARD)
+        for relay_pin in self.relay_pins:
+            gpio.setup(relay_pin, gpio.OUT, initial=gpio.LOW)
+
+        # Throttle Variables
+        self._zone_commands = [0] * len(zones)
+        self._window_start = None
+        self._window_states = [[False] * WINDOW_SLOTS for _ in zones]
+        self._window_edges = []
+        self.granted_duties = [0] * len(zones)
+
+        self.throttle_thread = None
+        self._throttle_thread_flag = False
+        self.throttle_thread_running = False
+        self._wake_event = threading.Event()  # Set to cut the current edge sleep short when stopping
+
+        # Measured relay on-time per zone, and budget reporting
+        self._relay_states = [False] * len(zones)
+        self._relay_on_since = [None] * len(zones)
+        self.relay_on_seconds = [0.0] * len(zones)
+        self.budget_limited_seconds = 0.0
+        self.peak_load = 0.0
+
+        # Instrumentation
+        self._relay_switches = [REGISTRY.counter("kiln_relay_switches_total", "Relay on/off transitions",
+                                                 dict(labels or {}, pin=relay_pin)) for relay_pin in self.relay_pins]
+        self._window_time = REGISTRY.histogram("kiln_throttle_window_seconds",
+                                               "Measured throttle window length (target " + str(WINDOW_SECONDS) + "s)",
+                                               PERIOD_BUCKETS, labels)
+        self._budget_limited = REGISTRY.counter("kiln_zone_budget_limited_seconds_total",
+                                                "Time zone duties were cut to stay within the load budget", labels)
+        self._peak_load = REGISTRY.gauge("kiln_zone_peak_load", "Highest total load of zones on at once", labels)
+        self._stop_time = REGISTRY.histogram("kiln_thread_stop_seconds",
+                                             "Time taken for a stop_*_thread call to return", PERIOD_BUCKETS,
+                                             dict(labels or {}, thread="throttle_interface_thread"))
+
+    def _set_zone_relay(self, zone, on):
+        if on != self._relay_states[zone]:
+            now = time.monotonic()
+            if on:
+                self._relay_on_since[zone] = now
+            else:
+                self.relay_on_seconds[zone] += now - self._relay_on_since[zone]
+                self._relay_on_since[zone] = None
+            self._relay_states[zone] = on
+            self._relay_switches[zone].value += 1
+            if TRACER.enabled:
+                TRACER.instant("relay_on" if on else "relay_off", TRACE_ARGS, self.relay_pins[zone],
+                               self._zone_commands[zone])
+        self.gpio.output(self.relay_pins[zone], self.gpio.HIGH if on else self.gpio.LOW)
+
+    def _set_relay(self, on):
+        # Every zone at once - used to force all elements off
+        for zone in range(len(self.relay_pins)):
+            self._set_zone_relay(zone, on)
+
+    def get_relay_on_seconds(self):
+        """
+        :return: Full power equivalent seconds - each zone's on-time weighted by its share of the total load
+        """
+        now = time.monotonic()
+        total = 0.0
+        for zone, load in enumerate(self.loads):
+            on_since = self._relay_on_since[zone]
+            seconds = self.relay_on_seconds[zone] + (now - on_since if on_since is not None else 0)
+            total += seconds * load
+        return total / sum(self.loads)
+
+    def get_load(self):
+        return sum(load for load, on in zip(self.loads, self._relay_states) if on)
+
+    def start_throttle_thread(self):
+        if not self.throttle_thread_running:
+            self._throttle_thread_flag = True
+            self._wake_event.clear()
+            self.throttle_thread = threading.Thread(group=None, target=self._run, name="throttle_interface_thread")
+            self.throttle_thread.start()
+            return True
+        else:
+            return False
+
+    def _run(self):
+        self.throttle_thread_running = True
+        self._window_start = None
+        while self._throttle_thread_flag:
+            # Sleep until the next relay edge
+            self._wake_event.wait(self.tick())
+
+        self.set_throttle(0)
+        self._set_relay(False)
+        self.throttle_thread_running = False
+
+    def _start_window(self, now):
+        if self._window_start is not None:
+            self._window_time.observe(now - self._window_start)
+        self._window_start = now
+        # Latch the zone commands for this window and phase them against the budget
+        commands = list(self._zone_commands)
+        self._window_states, self.granted_duties = plan_window([WINDOW_SLOTS / 100 * command for command in commands],
+                                                               self.loads, self.load_budget)
+        if any(granted < int(WINDOW_SLOTS / 100 * command) for granted, command in zip(self.granted_duties,
+                                                                                        commands)):
+            self.budget_limited_seconds += WINDOW_SECONDS
+            self._budget_limited.value += WINDOW_SECONDS
+        # Slots where any zone switches, so tick() can sleep straight to the next one
+        self._window_edges = [slot for slot in range(1, WINDOW_SLOTS)
+                              if any(states[slot] != states[slot - 1] for states in self._window_states)]
+
+    def tick(self):
+        """
+        Switches every zone relay for the current point in the burst window. Called by the throttle thread, or by
+        the KilnManager control executive when the kiln is managed.
+        :return: Seconds until a relay next needs to switch
+        """
+        now = time.monotonic()
+        if self._window_start is None or now - self._window_start >= WINDOW_SECONDS:
+            self._start_window(now)
+
+        slot_seconds = WINDOW_SECONDS / WINDOW_SLOTS
+        elapsed = now - self._window_start
+        slot = min(int(elapsed / slot_seconds), WINDOW_SLOTS - 1)
+        # Switch off before on, so the load never briefly exceeds the budget at an edge
+        for on in (False, True):
+            for zone, states in enumerate(self._window_states):
+                if states[slot] == on:
+                    self._set_zone_relay(zone, on)
+        load = self.get_load()
+        if load > self.peak_load:
+            self.peak_load = load
+            self._peak_load.value = load
+
+        next_edge = next((edge for edge in self._window_edges if edge > slot), WINDOW_SLOTS)
+        return max(next_edge * slot_seconds - elapsed, 0.001)
+
+    def set_zone_throttle(self, zone, throttle_command):
+        throttle = int(throttle_command)
+        if throttle < 0 or throttle > 100:
+            print("MultiZoneThrottle: Error - Invalid Throttle Command for zone " + str(zone) +
+                  ". Setting zone throttle to 0!")
+            self._zone_commands[zone] = 0
+            return False
+        self._zone_commands[zone] = throttle
+        return True
+
+    def set_throttle(self, throttle_command):
+        # Same command for every zone
+        return all([self.set_zone_throttle(zone, throttle_command) for zone in range(len(self.relay_pins))])
+
+    def get_stats(self):
+        text = "Zones: " + ", ".join(str(command) + "%" + ("" if granted >= command else " (" + str(granted) + "%)")
+                                     for command, granted in zip(self._zone_commands, self.granted_duties))
+        text += "\nPeak Zone Load: " + str(round(self.peak_load, 1))
+        if self.load_budget is not None:
+            text += " of " + str(self.load_budget) + ", Budget Limited: " + \
+                    str(round(self.budget_limited_seconds / 60, 1)) + " minutes"
+        return text + "\n"
+
+    def stop_throttle_thread(self):
+        start = time.monotonic()
+        self._throttle_thread_flag = False
+        self._wake_event.set()
+        # wait for thread to shutdown
+        while self.throttle_thread_running:
+            time.sleep(0.1)
+        self._stop_time.observe(time.monotonic() - start)
+
+    def cleanup(self):
+        # Only release this kiln's pins - other kilns in the same process may still be driving theirs
+        for relay_pin in self.relay_pins:
+            self.gpio.cleanup(relay_pin)
+
+    def shutdown(self):
+        self.stop_throttle_thread()
+        self._set_relay(False)
+        self.cleanup()
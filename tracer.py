@@ -0,0 +1,188 @@
+import array
+import json
+import os
+import threading
+import time
+
+# Arg values kept per event. Args are numbers (bools are stored as 0/1), kept as 32 bit floats
+MAX_ARGS = 4
+
+PHASE_COMPLETE = ord("X")
+PHASE_INSTANT = ord("i")
+
+
+class _ThreadBuffer:
+    # Fixed size ring of events for a single thread, as preallocated parallel arrays so recording an event keeps
+    # no new objects alive (names and arg name tuples are shared constants). Only the owning thread writes to it
+    __slots__ = ("names", "arg_names", "phases", "starts", "durations", "args", "size", "index", "thread_id",
+                 "thread_name")
+
+    def __init__(self, size):
+        self.names = [None] * size
+        self.arg_names = [None] * size
+        self.phases = bytearray(size)
+        self.starts = array.array("d", bytes(8 * size))
+        self.durations = array.array("d", bytes(8 * size))
+        self.args = array.array("f", bytes(4 * MAX_ARGS * size))
+        self.size = size
+        self.index = 0
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+
+    def record(self, phase, name, start, duration, arg_names, values):
+        slot = self.index % self.size
+        self.names[slot] = name
+        self.arg_names[slot] = arg_names
+        self.phases[slot] = phase
+        self.starts[slot] = start
+        self.durations[slot] = duration
+        offset = slot * MAX_ARGS
+        for i, value in enumerate(values[:MAX_ARGS]):
+            self.args[offset + i] = value
+        self.index += 1
+
+
+class Tracer:
+    """
+    Opt-in span tracer for the control threads. Writes Chrome Trace Event JSON (chrome://tracing, ui.perfetto.dev).
+
+    Each thread records into its own preallocated ring buffer, so recording never takes a lock. When disabled,
+    begin() returns 0 and callers skip end() entirely. Arg names are a constant tuple, followed by the values:
+
+        TRACE_ARGS = ("error", "throttle")
+        ...
+        t0 = TRACER.begin()
+        ... work ...
+        if t0:
+            TRACER.end("pi_compute", t0, TRACE_ARGS, error, throttle)
+
+    Memory is fixed once a thread has recorded its first event: about 50 bytes per event, so 3.2MB per thread at
+    the default buffer size (~13MB for the SPI, scheduler, PI and monitor threads of a kiln). A thread recording
+    for several components or kilns calls scale_thread_buffer() first, so it covers the same time - the
+    KilnManager threads do, for ~16MB per managed kiln.
+    """
+
+    def __init__(self, buffer_size=65536):
+        """
+        :param buffer_size: Events kept per thread. The oldest are overwritten once full.
+        65536 covers a ~18 hour firing at the 1Hz control rates.
+        """
+        self.enabled = False
+        self.buffer_size = buffer_size
+        self._local = threading.local()
+        self._buffers = []
+        self._lock = threading.Lock()
+        self._epoch = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def scale_thread_buffer(self, scale):
+        """
+        Sizes the calling thread's buffer at scale times buffer_size, for a thread recording the events of that many
+        1Hz control loops. Must be called before the thread's first event. Does nothing while disabled
+        """
+        if not self.enabled or getattr(self._local, "buffer", None) is not None:
+            return
+        buffer = _ThreadBuffer(int(self.buffer_size * scale))
+        self._local.buffer = buffer
+        with self._lock:
+            self._buffers.append(buffer)
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            for buffer in self._buffers:
+                buffer.names = [None] * buffer.size
+                buffer.index = 0
+
+    def _buffer(self):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = _ThreadBuffer(self.buffer_size)
+            self._local.buffer = buffer
+            with self._lock:
+                self._buffers.append(buffer)
+        return buffer
+
+    def begin(self):
+        """
+        :return: Monotonic start timestamp of a span, or 0 if tracing is disabled
+        """
+        if not self.enabled:
+            return 0
+        return time.perf_counter()
+
+    def end(self, name, start, arg_names=(), *values):
+        """
+        Records a complete span from start (as returned by begin()) to now
+        :param name: Span name
+        :param start: Start timestamp from begin()
+        :param arg_names: Optional tuple of arg names to attach to the span, a constant shared between calls
+        :param values: Numeric arg values, in arg_names order. Only the first MAX_ARGS are kept
+        """
+        now = time.perf_counter()
+        self._buffer().record(PHASE_COMPLETE, name, start, now - start, arg_names, values)
+
+    def instant(self, name, arg_names=(), *values):
+        """
+        Records a zero length event (ie. a relay edge), with args as for end()
+        """
+        if not self.enabled:
+            return
+        self._buffer().record(PHASE_INSTANT, name, time.perf_counter(), 0.0, arg_names, values)
+
+    def get_trace(self):
+        """
+        :return: Chrome Trace Event format dict of every recorded event
+        """
+        pid = os.getpid()
+        trace_events = []
+        with self._lock:
+            buffers = list(self._buffers)
+        for buffer in buffers:
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": buffer.thread_id,
+                                 "args": {"name": buffer.thread_name}})
+            # Copy the ring before walking it - its owning thread may still be writing
+            index = buffer.index
+            names, arg_names, phases = list(buffer.names), list(buffer.arg_names), bytes(buffer.phases)
+            starts, durations, args = buffer.starts[:], buffer.durations[:], buffer.args[:]
+            count = min(index, buffer.size)
+            start_index = index - count
+            for i in range(start_index, start_index + count):
+                slot = i % buffer.size
+                if names[slot] is None:
+                    continue
+                trace_event = {"name": names[slot], "ph": chr(phases[slot]), "pid": pid, "tid": buffer.thread_id,
+                               "ts": round((starts[slot] - self._epoch) * 1e6, 1)}
+                if phases[slot] == PHASE_COMPLETE:
+                    trace_event["dur"] = round(durations[slot] * 1e6, 1)
+                else:
+                    trace_event["s"] = "t"
+                if arg_names[slot]:
+                    offset = slot * MAX_ARGS
+                    trace_event["args"] = {key: _arg_value(value) for key, value in
+                                           zip(arg_names[slot], args[offset:offset + MAX_ARGS])}
+                trace_events.append(trace_event)
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def dump(self, path):
+        """
+        Atomically writes the trace to a Chrome Trace Event JSON file
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.get_trace(), file)
+        os.replace(tmp_path, path)
+
+
+def _arg_value(value):
+    # Back from a 32 bit float, without its noise digits. Whole numbers (pins, steps, bools) as ints
+    value = float("%.7g" % value)
+    return int(value) if value.is_integer() else value
+
+
+# Process-wide tracer, disabled until enable() is called
+TRACER = Tracer()